@@ -7,17 +7,51 @@
 # Ex: AUDIOBOOK_DIR = "/path/to/library/"
 AUDIOBOOK_DIR = "/home/jared/organized_audiobooks/"
 
+# Location of library index
+# Granger keeps track of the books already in your library here, so it doesn't
+# have to crawl the library on every run. Defaults to '.granger.db' in
+# AUDIOBOOK_DIR when empty. Run Granger with '--rebuild-index' if the library
+# was changed by other programs.
+INDEX_FILE = ""
+
+# Number of author directories scanned at once when rebuilding the index
+INDEX_WORKERS = 8
+
 # Delete files after importing
 # If 'True', Granger will remove original audio files after importing to library
 # This can also be done on a case-by-case basis with the '-d' flag through the
 # command line.
 DELETE = False
 
+# How audio files are brought into the library. Options are 'copy', 'move',
+# 'hardlink', 'reflink', 'symlink' and 'auto'.
+# 'copy': Copy files, leaving the originals alone
+# 'move': Move files, same as setting DELETE
+# 'hardlink': Link files into the library, taking no extra space. Only works
+#             when input and library are on the same filesystem.
+# 'reflink': Clone files on filesystems that can share file data (Btrfs, XFS)
+# 'symlink': Point to the original files from the library
+# 'auto': Move files if DELETE is set. Otherwise hard link files on the same
+#         filesystem as the library and copy the rest.
+# Only files whose tags are already right are linked. Files that will get new
+# tags are copied instead, so the originals are never changed (for example,
+# torrents can keep seeding).
+# DELETE turns 'copy' and 'auto' into 'move'.
+# This can also be set with the '--import-mode' flag through the command line.
+IMPORT_MODE = "copy"
+
 # Recurse down through directories
 # If 'True', Granger will add all files in the given directory to the library
 # including all files in subdirectories
 RECURSE = True
 
+# Group file names that are nearly the same into one book
+# Files are always grouped if their names only differ in numbers, punctuation
+# and part or chapter words. Set this to the lowest similarity (between 0 and 1)
+# to also group names in the same directory with typos or stray tags, for
+# example 0.7. Use 0 to only group exact matches.
+GROUP_SIMILARITY = 0
+
 # Prompt level
 # If a book is not a good match, this determines whether the user is prompted
 # to make a decision
@@ -28,6 +62,14 @@ RECURSE = True
 #    it's match
 PROMPT_LEVEL = 2
 
+# How sure Granger has to be of the tags already in a book's files to use them
+# without searching Google Books, from 0 to 1. Tags are trusted more when every
+# file agrees on them, when they include a valid ISBN (or an ASIN that is one),
+# and when they match the file names. A single file with only a title tag needs
+# an ISBN to be trusted. Books with an ISBN are always looked up by it first.
+# Use a number over 1 to always search.
+TAG_CONFIDENCE = 0.75
+
 # Overwrite pre-existing audiobook
 # If a book that is being imported already exists in the library,
 # overwrite the old one. Options are 'always', 'never', 'size', and 'bitrate'.
@@ -49,3 +91,96 @@ WORDS = ["audiobooks", "audiobook", "audio", "book", " by ", "narrated", " full
 SPEC_CHARS = ['~', '`', '\'', '@', '$', '%', '^', '*', '=', '<', '>', '(', ')',
               '[', ']', '{', '}', '\"', '|', '\\', '+', '-', ':', '#', '/', '!',
               '?', ',', '.', '_', ';']
+
+# Number of books to fetch info for at once
+# Can also be set with the '--fetch-workers' flag through the command line.
+FETCH_WORKERS = 4
+
+# Number of directories to read at once when looking for files to import.
+# Reading directories on network filesystems is mostly waiting on the server,
+# so more workers find files faster there.
+# Can also be set with the '--crawl-workers' flag through the command line.
+CRAWL_WORKERS = 8
+
+# Maximum number of books fetched ahead of the one the user is looking at.
+# Keeps memory use flat when importing thousands of books.
+FETCH_LOOKAHEAD = 16
+
+# Number of results to ask Google Books for on each search (1-40)
+MAX_RESULTS = 10
+
+# Google API key
+# Optional, but raises the number of Google Books searches allowed per day.
+# Ex: GOOGLE_API_KEY = "AIza..."
+GOOGLE_API_KEY = ""
+
+# Maximum number of requests per second sent to Google Books and Google Images,
+# and how many may be sent at once before that limit kicks in. Use 0 for no
+# limit.
+RATE_LIMIT = 2
+RATE_BURST = 5
+
+# Maximum number of Google Books searches per day. Granger waits for the next
+# day rather than failing once this is used up. Use 0 for no limit.
+DAILY_QUOTA = 1000
+
+# Number of times a failed or throttled request is retried, and the longest
+# time in seconds to wait between attempts
+MAX_RETRIES = 5
+MAX_BACKOFF = 60
+
+# Number of seconds to wait for Google to accept a connection, and for data once
+# connected
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 20
+
+# Number of seconds allowed for looking up a single book, including retries.
+# Books that take longer are marked as failed lookups. Use 0 for no limit.
+BOOK_DEADLINE = 60
+
+# Number of seconds allowed for finding and downloading a cover image
+IMAGE_TIMEOUT = 60
+
+# Number of cover and author images looked for at once, while books are still
+# being selected
+IMAGE_WORKERS = 2
+
+# Cache directory
+# Granger keeps Google Books search results and images here so repeated imports
+# of the same files do not have to search again
+CACHE_DIR = "~/.cache/granger/"
+
+# Number of seconds cached search results stay valid. Use 0 to never expire.
+CACHE_TTL = 30 * 24 * 60 * 60
+
+# Maximum number of search results to keep in the cache. The least recently
+# used results are removed first. Use 0 for no limit.
+CACHE_SIZE = 10000
+
+# Number of seconds to remember that an image search found nothing, so it isn't
+# searched for again on every run. Use 0 to never search again.
+IMAGE_MISS_TTL = 7 * 24 * 60 * 60
+
+# Maximum number of audio files to remember stats for. The oldest entries are
+# removed first. Use 0 for no limit.
+STAT_CACHE_SIZE = 200000
+
+# Number of files to copy or move into the library at once, over all books
+TRANSFER_WORKERS = 4
+
+# Number of books read from each input disk, and written to each library disk,
+# at once. Books from different input disks queue separately, so a slow disk
+# doesn't hold up the others. Use 1 for spinning disks, where parallel writes
+# cause seeking.
+WRITE_WORKERS = 2
+
+# Bytes of padding left after tags when a file's tags no longer fit and it has
+# to be rewritten. Later tag changes then fit without rewriting the file again.
+# Big files get more, like mutagen does by default.
+TAG_PADDING = 64 * 1024
+
+# Number of worker processes for reading and tagging audio files. Reading and
+# tagging are CPU bound, so books with many files are done faster on more
+# cores. Use 0 to do everything in the main process.
+# Can also be set with the '--processes' flag through the command line.
+PROCESSES = 0
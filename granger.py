@@ -12,14 +12,32 @@ import argparse
 import sys
 import threading
 import queue
+import collections
+import itertools
+import concurrent.futures
+import multiprocessing
 import mutagen
-from mutagen.easyid3 import EasyID3
-from mutagen.mp4 import MP4, MP4Cover
 import re
 import signal
 import logging
 import datetime
 import string
+import functools
+import sqlite3
+import time
+import random
+import email.utils
+import struct
+import errno
+import mimetypes
+import hashlib
+import urllib.parse
+
+# Only needed to clone files on filesystems that support it
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 __author__ = "Jared Kick"
 __copyright__ = "Copyright 2018, Jared Kick, All rights reserved."
@@ -33,6 +51,9 @@ __status__ = "Prototype"
 
 FORMATS = [".ogg", ".flac", ".mp3", ".opus", ".m4a", ".mp4"]
 
+# Ways of bringing audio files into the library
+IMPORT_MODES = ["copy", "move", "hardlink", "reflink", "symlink", "auto"]
+
 # TODO: ADD DATABASE FUNCTIONALITY?
 
 # Setup command line arguments
@@ -46,13 +67,22 @@ parser.add_argument("-s", "--single-thread", help="Run in single thread mode.",
 parser.add_argument("-j", "--write-json", help="Write metadata to JSON file.", action="store_true")
 parser.add_argument("-i", "--no-images", help="Skip downloading cover images for book and author.", action="store_true")
 parser.add_argument('-e', '--write-description', help='Write book summary to desc.txt file for Booksonic.', action='store_true')
+parser.add_argument("--import-mode", choices=IMPORT_MODES, help="How audio files are brought into the library.")
+parser.add_argument("--processes", help="Number of worker processes for reading and tagging audio files.", type=int, default=config.PROCESSES)
+parser.add_argument("--fetch-workers", help="Number of books to fetch info for at once.", type=int, default=config.FETCH_WORKERS)
+parser.add_argument("--crawl-workers", help="Number of directories to read at once when looking for files.", type=int, default=config.CRAWL_WORKERS)
+parser.add_argument("--rebuild-index", help="Rebuild the library index from the files in the library.", action="store_true")
+parser.add_argument("--no-cache", help="Do not read or write the Google Books search cache.", action="store_true")
+parser.add_argument("--refresh", help="Ignore cached search results and fetch them again.", action="store_true")
 parser.add_argument("-l", "--log-level", choices=["debug", "info", "warning", "error", "critical"], help="Set the log level to be stored in granger.log.", default="info")
 
-# Parse all arguments
-args = parser.parse_args()
+# Arguments are parsed in main(), so worker processes that import this module
+# don't parse the command line again
+args = None
 
 # Queues for passing Audiobook objects between threads
-fetch_to_select_queue = queue.Queue()
+# Fetched books waiting for the user are limited to keep memory flat
+fetch_to_select_queue = queue.Queue(config.FETCH_LOOKAHEAD)
 select_to_write_queue = queue.Queue()
 
 # Signals to tell threads when to stop processing
@@ -62,29 +92,108 @@ select_done = False
 # Flag to manually stop 'fetch' thread abruptly
 fetch_stop_flag = False
 
+# Set to abort lookups that are in progress when 'fetch' thread is stopped
+fetch_cancel = threading.Event()
+
+# Set on SIGTERM to stop 'write' thread after the book it is working on
+write_cancel = threading.Event()
+
+# Client shared by all threads for Google Books lookups, set up in main()
+books_client = None
+
+# Rate limiter shared by all outbound lookups, set up in main()
+rate_limiter = None
+
+# Persistent cache of audio file stats, set up in main()
+stat_cache = None
+
+# Worker processes for reading and tagging audio files, set up in main() if
+# asked for
+process_pool = None
+
+# Looks for images while books are still being selected, set up in main() if
+# images are needed
+image_prefetcher = None
+
+# Images found on earlier runs, set up in main()
+image_store = None
+
 def stop_fetch_thread():
     # Flag to manually stop 'fetch' thread abruptly
     global fetch_stop_flag
     fetch_stop_flag = True
+    # Abort lookups that are in progress
+    fetch_cancel.set()
+
+# Put audiobook on 'select' queue, blocking while the queue is full
+# Gives up and returns False if 'fetch' thread is told to stop
+def put_fetched(audiobook):
+    while True:
+        try:
+            fetch_to_select_queue.put(audiobook, True, 0.5)
+            return True
+        except queue.Full:
+            if fetch_stop_flag:
+                return False
 
 # Thread that fetches book info before being presented to the user
-def fetch_thread(name, audiobooks):
-    # Loop through given audiobooks
-    for audiobook in audiobooks:
-        # Check flag to see if thread should stop
-        global fetch_stop_flag
-        if fetch_stop_flag:
-            break
-        # Get preliminary info for each
-        audiobook.get_info()
-        # Put on queue; block if queue is full
-        fetch_to_select_queue.put(audiobook, True, None)
-    stop_select_thread()
+# Info is fetched by a pool of workers, but books are handed to the select
+# thread in their original order. Only a limited number of books are fetched
+# ahead of the one being waited on.
+def fetch_thread(name, audiobooks, workers):
+    workers = max(1, workers)
+    lookahead = max(workers, config.FETCH_LOOKAHEAD)
+    pending = collections.deque()
+    books = iter(audiobooks)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    # Select thread is always told we are done, even if finding books fails,
+    # so it doesn't wait forever
+    try:
+        while True:
+            # Check flag to see if thread should stop
+            global fetch_stop_flag
+            if fetch_stop_flag:
+                break
+
+            # Keep lookahead window full
+            # Books may still be being found, so stop early if the oldest one is
+            # ready to be passed on
+            for audiobook in books:
+                # Get preliminary info for each
+                pending.append((audiobook, executor.submit(audiobook.get_info)))
+                if len(pending) >= lookahead or pending[0][1].done() or fetch_stop_flag:
+                    break
+            if not pending:
+                break
+
+            # Wait for the oldest book so order is kept
+            audiobook, future = pending.popleft()
+            try:
+                # Keep checking if thread should stop while waiting
+                while not fetch_stop_flag:
+                    try:
+                        future.result(0.5)
+                        break
+                    except concurrent.futures.TimeoutError:
+                        pass
+            except Exception as e:
+                # Pass book on anyway, it will show up with no matches
+                logging.error('Failed to fetch info for %s. Reason: %s',
+                              os.path.basename(audiobook.audio_files[0].file_abs_path), e)
+
+            # Put on queue; block if queue is full
+            if not put_fetched(audiobook):
+                break
+    finally:
+        # Drop books that have not started yet, and don't wait for the ones that
+        # have if we were told to stop
+        executor.shutdown(wait=not fetch_stop_flag, cancel_futures=True)
+        stop_select_thread()
 
 def stop_select_thread():
     # Tell select thread that all audiobooks are processed and in the queue
     # Send None message in queue to break out of .get() function
-    fetch_to_select_queue.put(None, True, None)
+    put_fetched(None)
     fetch_done = True
     
 def select_thread(name, library, dry_run):
@@ -99,10 +208,14 @@ def select_thread(name, library, dry_run):
             # Handle pre-existing book
             if audiobook.add_to_library:
                 library.check_existing(audiobook)
+            # Drop images found for info the user didn't pick
+            audiobook.discard_images()
             # Push audiobook onto next queue, blocking if queue is full
             # Only add book if it is valid
             if audiobook.add_to_library and not dry_run:
                 select_to_write_queue.put(audiobook, True, None)
+            else:
+                audiobook.release_images()
         # If 'None' message received, that means there're no more audiobooks
         else:
             break
@@ -114,27 +227,34 @@ def stop_write_thread():
     select_to_write_queue.put(None, True, None)
     select_done = True
         
-def write_thread(name, library, delete):
-    # Prep downlaod directory
-    reset_download_dir()
+def write_thread(name, library, import_mode):
+    # Books are handed to workers for the disks they are going between
+    scheduler = Write_Scheduler(library, import_mode, config.WRITE_WORKERS)
     
     # Loop through audiobooks while previous thread (select) is not done
     while not select_done or not select_to_write_queue.empty():
         # Get audiobook from queue, blocking if queue is empty
         audiobook = select_to_write_queue.get(True, None)
+        # Stop right away on SIGTERM, even if books are still queued
+        if write_cancel.is_set():
+            break
         if audiobook:
             # Write book to directory
-            library.add_book(audiobook, delete)
+            scheduler.submit(audiobook)
         # If 'None' message received, that means there're no more audiobooks
         else:
             break
-            
-    # Clean downlaod directory
-    reset_download_dir()
+
+    # Wait for books that are already being written
+    scheduler.close()
 
 
 def main():
 
+    # Parse all arguments
+    global args
+    args = parser.parse_args()
+
     # Setup SIGTERM handling
     signal.signal(signal.SIGTERM, terminate)
 
@@ -154,54 +274,92 @@ def main():
         print('ERROR: Invalid log level')
         sys.exit(1)
 
+    # Open search cache unless told not to
+    search_cache = None
+    if not args.no_cache:
+        search_cache = Search_Cache(os.path.join(os.path.expanduser(config.CACHE_DIR), 'searches.db'),
+                                    config.CACHE_TTL, config.CACHE_SIZE)
+
+    # Pace outbound requests so large imports do not run into quota errors
+    global rate_limiter
+    rate_limiter = Rate_Limiter(config.RATE_LIMIT, config.RATE_BURST, config.DAILY_QUOTA,
+                                os.path.join(os.path.expanduser(config.CACHE_DIR), 'quota.json'))
+
+    # Setup Google Books client, with a connection for every fetch worker
+    global books_client
+    books_client = Google_Books_Client(search_cache, args.refresh, args.fetch_workers, rate_limiter)
+
+    # Remember file stats so unchanged files don't have to be parsed again
+    global stat_cache
+    stat_cache = Stat_Cache(os.path.join(os.path.expanduser(config.CACHE_DIR), 'stats.db'),
+                            config.STAT_CACHE_SIZE)
+
+    # Work out how files are brought into the library
+    import_mode = args.import_mode or config.IMPORT_MODE
+    if import_mode not in IMPORT_MODES:
+        logging.critical("Invalid value for \"IMPORT_MODE\" in configuration file.")
+        raise ValueError
+    # Originals that are deleted anyway can just be moved
+    if (config.DELETE or args.delete) and import_mode in ["copy", "auto"]:
+        import_mode = "move"
+    logging.info('Import mode: %s', import_mode)
+
+    # Parsing audio files holds the GIL, so spread it over processes if asked
+    # Workers are started fresh rather than forked, since other threads may be
+    # holding locks
+    global process_pool
+    if args.processes > 0:
+        logging.info('Starting %d worker processes', args.processes)
+        process_pool = concurrent.futures.ProcessPoolExecutor(args.processes,
+                                                              multiprocessing.get_context('spawn'),
+                                                              setup_worker,
+                                                              (logging.getLogger().level,))
+
     library = Library(config.AUDIOBOOK_DIR)
 
-    # This is the list of directories that we will look through
-    # If recursive flag is there, we will add directories to this list
-    directory = args.input
-    
-    # Get all files to import
-    files_to_import = []
+    # Refresh index if library was changed outside of Granger
+    if args.rebuild_index:
+        library.rebuild_index()
+
+    # Look for cover and author images as soon as a book has been looked up, so
+    # the write stage doesn't have to wait for them
+    global image_prefetcher
+    global image_store
+    if not args.no_images and not args.dry_run:
+        image_prefetcher = Image_Prefetcher(config.IMAGE_WORKERS, library.base_dir)
+
+        # Keep every image found so it never has to be searched for again
+        if not args.no_cache:
+            image_store = Image_Store(os.path.join(os.path.expanduser(config.CACHE_DIR), 'images'),
+                                      config.CACHE_TTL, config.IMAGE_MISS_TTL)
+
+    # Make sure everything we were given exists before starting
     for file_or_dir in args.input:
-        if os.path.isfile(file_or_dir):
-            files_to_import.append(file_or_dir)
-        elif os.path.isdir(file_or_dir):
-            if config.RECURSE or args.recursive:
-                # Grab all files recursively
-                for (root, directories, files) in os.walk(file_or_dir, topdown=False):
-                    for name in files:
-                        # Make sure extension is valid
-                        ext = os.path.splitext(name)[-1]
-                        if ext in FORMATS:
-                            files_to_import.append(os.path.join(root, name))
-            # Otherwise, list all files in current directory
-            else:
-                for name in os.listdir(args.input):
-                    if os.path.isfile(name):
-                        # Make sure extension is valid
-                        ext = os.path.splitext(name)[-1]
-                        if ext in FORMATS:
-                            files_to_import.append(os.path.join(directory, name))
-        else:
+        if not os.path.isfile(file_or_dir) and not os.path.isdir(file_or_dir):
             print('What have you brought on this cursed land?')
             sys.exit()
-    
-    # Group similar files into separate audiobooks
-    if files_to_import:
-        audiobooks = library.group_files(files_to_import)
-    else:
-        return
+
+    # Find files and group similar ones into separate audiobooks as we go, so
+    # the first books can be looked up before every directory has been read
+    audiobooks = library.find_books(args.input, config.RECURSE or args.recursive, args.crawl_workers)
 
     if args.single_thread:
 
         logging.info('Running in single-thread mode')
 
         # Do everything one-by-one
+        # Books are still being found, so there is no total to log
         for i, audiobook in enumerate(audiobooks):
+            # Stop on SIGTERM, rather than writing books whose lookups were
+            # cancelled
+            if write_cancel.is_set():
+                break
 
             # Fetch preliminary info
-            logging.info('Fetching info for book %d of %d', i+1, len(audiobooks))
+            logging.info('Fetching info for book %d', i+1)
             audiobook.get_info()
+            if write_cancel.is_set():
+                break
 
             # Prompt user to select info
             logging.info('Prompting user for correct info')
@@ -211,13 +369,20 @@ def main():
             if audiobook.add_to_library:
                 library.check_existing(audiobook)
 
+            # Drop images found for info the user didn't pick
+            audiobook.discard_images()
+
             # Add book to library
             if audiobook.add_to_library:
                 if not args.dry_run:
-                    logging.info('Adding book %d of %d to library', i+1, len(audiobooks))
-                    library.add_book(audiobook, config.DELETE or args.delete)
+                    logging.info('Adding book %d to library', i+1)
+                    try:
+                        library.add_book(audiobook, import_mode)
+                    finally:
+                        audiobook.release_images()
                 else:
                     logging.info('Dry-run mode, not adding to library')
+                    audiobook.release_images()
             else:
                 logging.info('Book not valid, not adding to library')
 
@@ -226,15 +391,19 @@ def main():
         logging.info('Starting worker threads')
         fetch_info_thread = threading.Thread(target=fetch_thread,
                                              args=("fetch_info_thread",
-                                                   audiobooks))
+                                                   audiobooks,
+                                                   args.fetch_workers))
+        # Select thread may be blocked on user input, so don't let it keep the
+        # program alive on SIGTERM
         select_info_thread = threading.Thread(target=select_thread,
                                               args=("select_info_thread",
                                                     library,
-                                                    args.dry_run))
+                                                    args.dry_run),
+                                              daemon=True)
         write_book_thread = threading.Thread(target=write_thread,
                                              args=("write_book_thread",
                                                    library,
-                                                   config.DELETE or args.delete))
+                                                   import_mode))
                                      
         # Start the threads
         fetch_info_thread.start()
@@ -243,7 +412,8 @@ def main():
     
         # Wait for user to finish selecting data, or to abort
         logging.info('Waiting for select_info thread to finish')
-        select_info_thread.join()
+        while select_info_thread.is_alive() and not write_cancel.is_set():
+            select_info_thread.join(0.5)
     
         # If select_info thread exits (user aborts) close the fetch thread and
         # wait for write thread to finish
@@ -259,6 +429,18 @@ def main():
         logging.info('Waiting for write_book thread to finish')
         write_book_thread.join()
 
+    if process_pool:
+        process_pool.shutdown(cancel_futures=True)
+
+    if image_prefetcher:
+        image_prefetcher.shutdown()
+
+    rate_limiter.close()
+
+    logging.info('Stat cache: %d hits, %d misses', stat_cache.hits, stat_cache.misses)
+    logging.info('Tags saved to %d files, %d of them had to move audio data (%d MB)',
+                 tag_padding.saves, tag_padding.rewrites, tag_padding.bytes_moved/1000000)
+
 
 #########################################################
 #                       CLASSES                         #
@@ -266,7 +448,10 @@ def main():
 
 class Library:
     base_dir = ""
-    authors = []
+    # Authors by name
+    authors = {}
+    # Library_Index of authors, books and files in library
+    index = None
 
     def __init__(self, library_dir):
         if (os.path.isdir(library_dir)):
@@ -279,6 +464,27 @@ class Library:
                 raise NotADirectoryError(library_dir + ": not a valid directory")
             else:
                 self.base_dir = library_dir
+
+        self.authors = {}
+        # Lock for adding authors from more than one thread
+        self.authors_lock = threading.Lock()
+        # Files of every book are transferred by the same threads, so the
+        # library disk never has more than TRANSFER_WORKERS of them at once
+        self.transfers = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, config.TRANSFER_WORKERS))
+
+        # Open index, filling it from the library on first use
+        index_location = config.INDEX_FILE or os.path.join(self.base_dir, '.granger.db')
+        self.index = Library_Index(index_location)
+        if self.index.created:
+            self.rebuild_index()
+
+
+    # Rebuild index by scanning the whole library
+    def rebuild_index(self):
+        logging.info('Rebuilding library index: %s', self.base_dir)
+        print(colors.ENDC + 'Indexing library...')
+        self.index.rebuild(self.base_dir, config.INDEX_WORKERS)
+        self.authors = {}
                 
                 
     # Check if book exists in library and set data members accordingly
@@ -296,10 +502,10 @@ class Library:
         #clean_author_name = re.sub(r'[^a-z]+', '', author_name.lower())
         
         # Look for author of same name
-        for author in self.authors:
-            if author.name == author_name:
-                logging.info('Found existing author of name: \'%s\'', author.name)
-                return author
+        author = self.authors.get(author_name)
+        if author:
+            logging.info('Found existing author of name: \'%s\'', author.name)
+            return author
         
         # Otherwise create new author
         author = self.add_author(author_name)
@@ -307,49 +513,31 @@ class Library:
         return author
                 
                 
+    # Find audiobooks in 'inputs', a list of files and directories
+    # Books are yielded as soon as the directory they are in has been read
+    def find_books(self, inputs, recursive, workers):
+        for files in find_files(inputs, recursive, workers):
+            yield from self.group_files([path for path, stat in files], dict(files))
+
+
     # Group similar files for import
     # Take a list of file names and create a list of Audiobook objects
-    def group_files(self, filenames):
+    # 'stats' has os.stat() results of files by path, if they are known
+    def group_files(self, filenames, stats=None):
+        stats = stats or {}
+
         # Create list of lists of similar filenames
-        grouped_files = [[filenames[0]]]
-        filenames.pop(0)
+        grouper = File_Grouper(config.GROUP_SIMILARITY)
         for name in filenames:
-            used = False
-            for book in grouped_files:
-                
-                # Cleanse both names
-                temp_name = name
-                temp_book = book[0]
-
-                # Use only lower case
-                temp_name = temp_name.lower()
-                temp_book = temp_book.lower()
-
-                # Remove all non-alpha characters
-                temp_name = re.sub(r"[^a-z]+", "", temp_name)
-                temp_book = re.sub(r"[^a-z]+", "", temp_book)
-
-                # Remove chapter and part identifiers
-                identifiers = [ "part", "pt", "prt", "chap", "chapt", "chapter", "cpt", "chpt"]
-                for word in identifiers:
-                    temp_name = temp_name.replace(word, '')
-                    temp_book = temp_book.replace(word, '')
-
-                if temp_name == temp_book:
-                    # Add part name to book
-                    book.append(name)
-                    used = True
-                    break
-            # If filename doesn't match any other books, create a new one
-            if not used:
-                grouped_files.append([name])
+            grouper.add(name)
+        grouped_files = grouper.groups
                 
         # Group similar filenames into Audiobook
         books = []
         for book in grouped_files:
             audiobook = Audiobook()
             for name in book:
-                audiobook.add_file(name)
+                audiobook.add_file(name, stats.get(name))
             books.append(audiobook)
 
         for book in books:
@@ -362,7 +550,7 @@ class Library:
 
     # This function moves the audiobook and cover to pre-specified library
     # location
-    def add_book(self, book, delete):
+    def add_book(self, book, import_mode):
         # Get cover image
         if not args.no_images:
             book.get_cover()
@@ -371,28 +559,33 @@ class Library:
         author = self.get_author(book.author)
     
         # Add book to author
-        author.add_book(book, delete)
+        author.add_book(book, import_mode, self.transfers)
 
 
     def add_author(self, name):
-        # If author already exists, just return
-        for author in self.authors:
-            if name == author.name:
-                return
+        created = False
+        with self.authors_lock:
+            # If author already exists, just return it
+            if name in self.authors:
+                return self.authors[name]
 
-        # Otherwise create new author
-        author = Author(self.base_dir, name)
+            # Otherwise create new author
+            author = Author(self.base_dir, name, self.index)
 
-        # Create path for author
-        if not os.path.isdir(author.directory):
-            os.mkdir(author.directory)
+            # Create path for author unless index already knows about it
+            if not self.index.has_author(name) or not os.path.isdir(author.directory):
+                if not os.path.isdir(author.directory):
+                    os.mkdir(author.directory)
+                    created = True
 
-            # Get author image
-            if not args.no_images:
-                author.get_cover()
+                self.index.add_author(name, author.directory)
 
-        # Add newly created author to library object
-        self.authors.append(author)
+            # Add newly created author to library object
+            self.authors[name] = author
+
+        # Get author image without holding up other books while searching
+        if created and not args.no_images:
+            author.get_cover()
         
         return author
         
@@ -408,21 +601,26 @@ class Author:
     # Should contain only 'audiobook' objects
     books = []
 
-    def __init__(self, base_dir, author_name):
+    def __init__(self, base_dir, author_name, index=None):
         self.name = author_name
         # TODO: SANITIZE NAME FOR DIRECTORY
         self.directory = os.path.join(base_dir, author_name)
+        # Library_Index to keep up to date, if any
+        self.index = index
+        # Files being transferred into the author's books, which don't exist
+        # yet but must not be picked by another book being written at once
+        self.reserved = set()
+        self.reserved_lock = threading.Lock()
 
     # Add book will update the 'books' list as well as move the audiobook and cover files to
     # the proper directory
     # This function should only be called by library.add_book()
-    def add_book(self, book, delete):
+    def add_book(self, book, import_mode, transfers):
         # Directory that book will be moved to
         book.directory = os.path.join(self.directory, book.title)
 
         # Make sure book directory exists
-        if not os.path.isdir(book.directory):
-            os.mkdir(book.directory)
+        os.makedirs(book.directory, exist_ok=True)
 
         # Delete pre-existing book
         if book.delete_existing:
@@ -435,35 +633,49 @@ class Author:
         
         # TODO: REWRITE METADATA FILES IF THEY ALREADY EXIST
         
-        # Copy over new book
-        for audio_file in book.audio_files:
-            # Get file extension
-            ext = os.path.splitext(audio_file.file_abs_path)[-1]
-            
-            # Create new audio file location
-            new_location = os.path.join(book.directory, (audio_file.title + ext))
-            
-            # If same filename exists, we still want to keep both
-            num = 1
-            while os.path.isfile(new_location):
-                filename, ext = os.path.splitext(new_location)
-                new_location = filename + " " + str(num) + ext
-                num += 1
-            
-            # If delete source file
-            if delete:
-                # Move instead of copying
-                logging.info('Moving file: %s', os.path.basename(audio_file.file_abs_path))
-                logging.info('Destination: %s', new_location)
-                shutil.move(audio_file.file_abs_path, new_location)
-                
-            else:
-                # Copy file
-                logging.info('Copying file: %s', os.path.basename(audio_file.file_abs_path))
-                logging.info('Destination: %s', new_location)
-                shutil.copy2(audio_file.file_abs_path, new_location)
-                
-            # Update file path
+        # Pick new location of every file before copying any of them
+        new_locations = []
+        with self.reserved_lock:
+            for audio_file in book.audio_files:
+                # Get file extension
+                ext = os.path.splitext(audio_file.file_abs_path)[-1]
+
+                # Create new audio file location
+                new_location = os.path.join(book.directory, (audio_file.title + ext))
+
+                # If same filename exists, we still want to keep both
+                num = 1
+                while os.path.isfile(new_location) or new_location in self.reserved:
+                    filename, ext = os.path.splitext(new_location)
+                    new_location = filename + " " + str(num) + ext
+                    num += 1
+
+                new_locations.append(new_location)
+                self.reserved.add(new_location)
+
+        try:
+            # Files that will get new tags can't be linked
+            import_modes = book.get_import_modes(import_mode)
+
+            # Copy over new book, several files at a time, biggest first so the
+            # last file to finish isn't a big one
+            order = sorted(range(len(new_locations)), key=lambda i: book.audio_files[i].size, reverse=True)
+            start = time.monotonic()
+            sizes = transfers.map(transfer_file,
+                                  [book.audio_files[i].file_abs_path for i in order],
+                                  [new_locations[i] for i in order],
+                                  [import_modes[i] for i in order])
+            transferred = sum(sizes)
+        finally:
+            # Files exist now, or never will
+            with self.reserved_lock:
+                self.reserved.difference_update(new_locations)
+        elapsed = time.monotonic() - start
+        logging.info('Transferred %d MB in %.1f seconds (%.1f MB/s): %s', transferred/1000000, elapsed,
+                     transferred/1000000/elapsed if elapsed else 0, book.title)
+
+        # Update file paths
+        for audio_file, new_location in zip(book.audio_files, new_locations):
             audio_file.file_abs_path = new_location
             
         # Update audiobook object to contain all existing files for writing metadata
@@ -472,22 +684,20 @@ class Author:
             # Add_file returns if audiobook already contains file, so try all of them
             book.add_file(os.path.join(book.directory, f))
 
-        # Get image file location
-        if book.image_location:
-            file_extension = os.path.splitext(book.image_location)[-1]
-
-            # Set new location of image file
-            new_location = os.path.join(book.directory, "cover" + file_extension)
-
-            # Move and rename file to "cover"
-            shutil.move(book.image_location, new_location)
-            book.image_location = new_location
+        # Write cover image straight to its place in the library
+        # Cover art embedded in the files is copied out before tags are
+        # written, since that can move it around within the file
+        image = book.image
+        if not image and not args.no_images:
+            image = book.embedded_cover()
+        if image:
+            book.image_location = image.save(os.path.join(book.directory, "cover"))
 
-        # Write tags to audio file
+        # Write tags to audio file, which also updates file stats
         book.write_tags()
         
-        # Update file stats
-        book.get_stats()
+        # Update book stats
+        book.sum_stats()
         
         # Write json metadata file
         if args.write_json:
@@ -497,6 +707,10 @@ class Author:
         if args.write_description:
             book.write_description()
 
+        # Record book and its files in index
+        if self.index:
+            self.index.add_book(self.name, book)
+
         # Add book to author
         self.books.append(book)
         
@@ -505,8 +719,11 @@ class Author:
         # Get directory of author if they already exist in the library
         audiobook_dir = os.path.join(self.directory, book.title)
         
-        if os.path.isdir(audiobook_dir):
-          
+        # Look book up in index, falling back to reading files without one
+        existing_book = None
+        if self.index:
+            existing_book = self.index.get_book(self.name, book.title)
+        elif os.path.isdir(audiobook_dir):
             # Audiobook already exists in library
             files = [f for f in os.listdir(audiobook_dir) if os.path.isfile(os.path.join(audiobook_dir, f))]
 
@@ -517,6 +734,8 @@ class Author:
 
             # Get stats
             existing_book.get_stats()
+
+        if existing_book:
                     
             if config.OVERWRITE == "bitrate":
                 if book.bitrate > existing_book.bitrate:
@@ -580,17 +799,11 @@ class Author:
     def get_cover(self):
         # Get author image
         logging.info('Getting image for author: %s', self.name)
-        image_location = get_image("\"" + self.name + "\" author")
+        image = fetch_image(author_image_term(self.name))
 
-        if image_location:
-            # Get file extension
-            file_extension = os.path.splitext(image_location)[-1]
-
-            # All author images are named "folder"
-            self.image_location = os.path.join(self.directory, "folder" + file_extension)
-
-            # Move image to library author directory
-            shutil.move(image_location, self.image_location)
+        # All author images are named "folder"
+        if image:
+            self.image_location = image.save(os.path.join(self.directory, "folder"))
         
 
 # This is what we are going to use to build our new audiobook file
@@ -617,6 +830,9 @@ class Audiobook:
     # Holds list of matches from Google Books API
     matches = []
 
+    # Signifies that Google Books could not be reached, rather than no matches
+    lookup_failed = False
+
     # Location of where audiobook will be written
     directory = ""
     
@@ -629,9 +845,14 @@ class Audiobook:
     # List of Audio_File objects
     audio_files = []
     
+    # Image to use as book cover
+    image = None
     # Location of the book cover image
     image_location = ""
 
+    # Search terms of images being looked for ahead of time
+    prefetched_images = []
+
 
     def __init__(self):
         self.aggregate_rating = 0.0
@@ -653,9 +874,12 @@ class Audiobook:
         self.subtitle = ""
         self.title = ""
         self.matches = []
+        self.lookup_failed = False
         self.directory = ""
         self.audio_files = []
+        self.image = None
         self.image_location = ""
+        self.prefetched_images = []
 
 
     # Print audiobook, mostly for debugging and testing purposes
@@ -668,7 +892,8 @@ class Audiobook:
 
 
     # Add audio file to audiobook object
-    def add_file(self, filename):
+    # 'stat' is os.stat() result of file, if it is already known
+    def add_file(self, filename, stat=None):
         # Get file exension
         ext = os.path.splitext(filename)[-1]
         
@@ -679,159 +904,221 @@ class Audiobook:
         
         # Only add acceptable file formats
         if ext in FORMATS:
-            self.audio_files.append(Audio_File(filename))
+            self.audio_files.append(Audio_File(filename, stat))
 
 
     # Get a cover image for the audiobook
+    # Cover art embedded in the files is used instead, if there is any
     def get_cover(self):
+        if self.embedded_cover():
+            logging.info('Using embedded image for book: %s', self.title)
+            return
         logging.info('Getting image for book: %s', self.title)
-        self.image_location = get_image("\"" + self.title + "\" audiobook")
+        self.image = fetch_image(book_image_term(self.title))
+
+
+    # Returns Image of cover art embedded in the first file that has any, or
+    # None
+    def embedded_cover(self):
+        for audio_file in sorted(self.audio_files):
+            if audio_file.cover:
+                offset, length, mime = audio_file.cover
+                extension = mimetypes.guess_extension(mime) or '.jpg'
+                return Image(None, extension, audio_file.file_abs_path, offset, length)
+        return None
+
+
+    # Start looking for cover and author images for the best match, so they are
+    # ready by the time the book is written
+    def prefetch_images(self):
+        if not image_prefetcher or not self.matches:
+            return
+        info = self.matches[0]['info']
+        author = info['authors'][0] if 'authors' in info else ""
+        self.prefetched_images += image_prefetcher.prefetch(info.get('title', ""), author,
+                                                            cover=not self.embedded_cover())
+
+
+    # Drop prefetched images that don't match the selected title and author
+    def discard_images(self):
+        wanted = []
+        if self.add_to_library:
+            wanted = [book_image_term(self.title), author_image_term(self.author)]
+        for search_term in self.prefetched_images:
+            if search_term not in wanted:
+                image_prefetcher.discard(search_term)
+        self.prefetched_images = [search_term for search_term in self.prefetched_images if search_term in wanted]
+
+
+    # Let go of every image prefetched for the book, once it has been written
+    # or skipped
+    def release_images(self):
+        for search_term in self.prefetched_images:
+            image_prefetcher.discard(search_term)
+        self.prefetched_images = []
 
 
     # Search Google Books API for information about book based on file name
     def get_info(self, search_term=None):
 
+        # Give up on the book if it can't be looked up in time, reading its
+        # files included
+        deadline = None
+        if config.BOOK_DEADLINE:
+            deadline = time.monotonic() + config.BOOK_DEADLINE
+
         # Get book stats
         self.get_stats()
 
         # Get rid of old matches
         self.matches = []
+        self.lookup_failed = False
 
         # If search_term is not specified in parameters, get info from filename
         if search_term is None:
 
             # Gets similarity between all filenames in Audiobook to use as search term
-            search_term = os.path.splitext(os.path.basename(self.audio_files[0].file_abs_path))[0]
+            search_term, is_excerpt = normalizer.search_term(self.audio_files[0].file_abs_path)
 
-            # Remove part and chapter numbers
-            search_term = re.sub(self.audio_files[0].PART_FINDER_REGEX_STRING, '', search_term)
+            # Set reminder if file is an excerpt
+            if is_excerpt:
+                self.is_excerpt = True
 
-            # Use only lower-case letters for simplicity
-            search_term = search_term.lower()
+            # Tags already in the files may be enough to know the book, and
+            # are a better search term than a file name if they aren't
+            info, confidence = self.tag_info(search_term)
+            if info:
+                self.matches = self.match_tags(info, confidence, deadline)
+                search_term = (info['title'] + " " + info['authors'][0]).lower()
 
-            # Find and remove website names
-            website_domains = [ ".com", ".net", ".org", ".io", ".cc" ]
-            for domain in website_domains:
-                search_term = re.sub("[^a-z0-9][a-z0-9]*\\" + domain, "", search_term)
+        # Search Google Books API
+        if not self.matches:
+            self.matches = self.search(search_term, deadline)
 
-            # Set reminder if file is an excerpt
-            if "excerpt" in search_term:
-                self.is_excerpt = True
-                search_term = search_term.replace("excerpt", '')
+        if self.matches:
+            # The best match is usually the right one, so start on its images
+            self.prefetch_images()
 
-            # Remove unhelpful words
-            for word in config.WORDS:
-                search_term = search_term.replace(word, ' ')
+            # Organize all files by parts
+            if len(self.audio_files) > 1:
+                self.get_parts()
 
-            # Remove special characters
-            for char in config.SPEC_CHARS:
-                search_term = search_term.replace(char, ' ')
 
+    # Search Google Books API for 'search_term'
+    # Returns matches sorted by similarity ratio in descending order
+    def search(self, search_term, deadline):
         logging.info('Fetching info for search term: %s', search_term)
 
-        # Search Google Books API
-        response = requests.get("https://www.googleapis.com/books/v1/volumes?q=" +
-                                search_term.replace(' ', '+'))
-
-        # Make JSON response readable
-        response = response.json()
+        try:
+            items = books_client.search(search_term, deadline, fetch_cancel)
+        except Lookup_Error as e:
+            logging.error('Lookup failed for search term: %s. Reason: %s', search_term, e)
+            self.lookup_failed = True
+            return []
 
         # Compare titles by iterating through titles and seeing which ones match original
         # While Google Books search is good, occasionally it returns books that are
         # clearly not a match, so we will crosscheck the result with the original string
         # and see which one is the closest
-        if "items" in response:
-            for item in response["items"]:
-                # Make sure there is a space after any punctuation in the title
-                if 'title' in item['volumeInfo']:
-                    item['volumeInfo']['title'] = re.sub(r'([\.,!?;:-])(?=[^ \.,!?;:\-$])', r'\1 ', item['volumeInfo']['title'])
-            
-                # If author is formatted like "J.R.R. Tolkien", replace with "J. R. R. Tolkien"
-                if 'authors' in item['volumeInfo']:
-                    item['volumeInfo']['authors'][0] = re.sub(r'(.\.)(?=[^ ])', r'\1 ', item['volumeInfo']['authors'][0])
-            
-                # If author is formatted like "J R R Tolkien", replace with "J. R. R. Tolkien"
-                if 'authors' in item['volumeInfo']:
-                    item['volumeInfo']['authors'][0] = re.sub(r'(?<=[^a-zA-Z])?([A-Z])([ ])', r'\1.\2', item['volumeInfo']['authors'][0])
-                    
-                # Fix capitalizations of title, subtitle, and author
-                # Do NOT capitalize articles, coordinate conjunctions, nor prepositions
-                # that are shorter than three letters long
-                if 'title' in item['volumeInfo']:
-                    item['volumeInfo']['title'] = titleify(item['volumeInfo']['title'])
-                if 'subtitle' in item['volumeInfo']:
-                    item['volumeInfo']['subtitle'] = titleify(item['volumeInfo']['subtitle'])
-                if 'authors' in item['volumeInfo']:
-                    item['volumeInfo']['authors'][0] = titleify(item['volumeInfo']['authors'][0])
-            
-                # Start by comparing with just the title
-                response_str = ""
-                if "title" in item["volumeInfo"]:
-                    response_str += item["volumeInfo"]["title"]
-                response_str = response_str.lower()
-                # Remove special characters
-                for char in config.SPEC_CHARS:
-                    response_str = response_str.replace(char, ' ')
-                ratio = jaccard_similarity(search_term.split(), response_str.split())
-                match = {"ratio": ratio, "info": item["volumeInfo"]}
-                
-                # Search using just the title and author
-                response_str = ""
-                if "title" in item["volumeInfo"]:
-                    response_str += item["volumeInfo"]["title"]
-                if "authors" in item["volumeInfo"]:
-                    response_str += " "
-                    response_str += item["volumeInfo"]["authors"][0]
-                response_str = response_str.lower()
-                # Remove special characters
-                for char in config.SPEC_CHARS:
-                    response_str = response_str.replace(char, ' ')
-                ratio = jaccard_similarity(search_term.split(), response_str.split())
-                if ratio > match["ratio"]:
-                    match = {"ratio": ratio, "info": item["volumeInfo"]}
-
-                # Search again, but this time including the subtitle
-                response_str = ""
-                if "title" in item["volumeInfo"]:
-                    response_str += item["volumeInfo"]["title"]
-                if "subtitle" in item["volumeInfo"]:
-                    response_str += " " + item["volumeInfo"]["subtitle"]
-                if "authors" in item["volumeInfo"]:
-                    response_str += " " + item["volumeInfo"]["authors"][0]
-                response_str = response_str.lower()
-                # Remove special characters
-                for char in config.SPEC_CHARS:
-                    response_str = response_str.replace(char, ' ')
-                ratio = jaccard_similarity(search_term.split(), response_str.split())
-                if ratio > match["ratio"]:
-                    match = {"ratio": ratio, "info": item["volumeInfo"]}
-
-                # Add best match of this run to list of matches
-                self.matches.append(match)
-
-            logging.info('Received %d matches for search term: %s', len(self.matches), search_term)
-
-            # Sort list according to similarity ratio in descending order
-            self.matches = sorted(self.matches, key = lambda i: i["ratio"], reverse=True)
-            
-            # Organize all files by parts
-            if len(self.audio_files) > 1:
-                self.get_parts()
-            
-            
+        matches = rank_matches(search_term, items)
+        logging.info('Received %d matches for search term: %s', len(matches), search_term)
+        return matches
+
+
+    # Get title, author and ISBN of book from tags already in its files
+    # 'search_term' is the one made from the file names, to check tags against
+    # Returns (info, confidence), where info is laid out like Google Books
+    # 'volumeInfo' and confidence is from 0 to 1 like the ratio of a match
+    # Info is None if files don't say what book they are
+    def tag_info(self, search_term):
+        tags = [audio_file.tags for audio_file in self.audio_files]
+        first = next((file_tags for file_tags in tags if file_tags.get('album')), None)
+        # A single file may only have its own title
+        title_only = first is None and len(tags) == 1
+        if title_only:
+            first = dict(tags[0], album=tags[0].get('title', ""))
+        if first is None:
+            return None, 0.0
+
+        title = first['album']
+        author = first.get('albumartist') or first.get('artist', "")
+        if not author or title.lower() in UNKNOWN_TAGS or author.lower() in UNKNOWN_TAGS:
+            return None, 0.0
+
+        info = {'title': normalizer.format_title(title),
+                'authors': [normalizer.format_author(author)]}
+        isbn = parse_isbn(first.get('isbn', "")) or parse_isbn(first.get('asin', ""))
+        if isbn:
+            info['industryIdentifiers'] = [{'type': 'ISBN_' + str(len(isbn)), 'identifier': isbn}]
+
+        # Tags are more likely to be right if every file agrees on them...
+        confidence = 0.5
+        if len(tags) > 1 and all(file_tags.get('album') == title and
+                                 (file_tags.get('albumartist') or file_tags.get('artist')) == author
+                                 for file_tags in tags):
+            confidence += 0.25
+        # ...and if whatever wrote them also wrote a valid ISBN, or the file
+        # names say the same thing
+        # A title standing in for the album is often made from the file name in
+        # the first place, so only an ISBN counts for it
+        title_words = normalizer.tokens(title)
+        if isbn:
+            confidence += 0.25
+        elif (not title_only and title_words and
+              len(title_words & normalizer.tokens(search_term)) / len(title_words) >= 0.5):
+            confidence += 0.25
+
+        logging.info('Found tags with %.0f%% confidence: %s by %s', confidence * 100, title, author)
+        return info, confidence
+
+
+    # Get matches for book from tag info, without a text search if possible
+    # A book with an ISBN is looked up by it, and if it is found that is a
+    # sure match. Otherwise tags that are trustworthy enough are used as is.
+    # Returns list of matches, empty if a text search is still needed
+    def match_tags(self, info, confidence, deadline):
+        if 'industryIdentifiers' in info:
+            isbn = info['industryIdentifiers'][0]['identifier']
+            for match in self.search('isbn:' + isbn, deadline):
+                identifiers = [parse_isbn(identifier['identifier'])
+                               for identifier in match['info'].get('industryIdentifiers', [])]
+                if isbn_13(isbn) in [isbn_13(identifier) for identifier in identifiers if identifier]:
+                    logging.info('Found book by ISBN: %s', isbn)
+                    match['ratio'] = 1.0
+                    return [match]
+
+        if confidence >= config.TAG_CONFIDENCE:
+            logging.info('Using tags without searching: %s', info['title'])
+            return [{"ratio": confidence, "info": info}]
+        return []
+
+
     # Get stats (bitrate, length, and size)
     def get_stats(self):
     
+        # Update individual file stats
+        if process_pool:
+            # Check stat cache here, and probe the rest in worker processes
+            stats = [(audio_file, audio_file.get_cached_stats()) for audio_file in self.audio_files]
+            stats = [(audio_file, stat) for audio_file, stat in stats if stat]
+            probes = process_pool.map(probe_audio, [audio_file.file_abs_path for audio_file, stat in stats])
+            for (audio_file, stat), probe in zip(stats, probes):
+                audio_file.update_stats(stat, probe)
+        else:
+            for audio_file in self.audio_files:
+                audio_file.get_stats()
+
+        self.sum_stats()
+
+
+    # Calculate overall book stats from the stats of each file
+    def sum_stats(self):
         # Get size, average bitrate, and length
         total_size = 0
         average_bitrate = 0
         total_length = 0
-        
-        # Loop over all files in audiobook
+
         for audio_file in self.audio_files:
-            # Update individual file stats
-            audio_file.get_stats()
-            
             # Calculate overall book stats
             total_size += audio_file.size
             average_bitrate += audio_file.size * audio_file.bitrate
@@ -860,9 +1147,12 @@ class Audiobook:
         info_correct = False
         
         # Get match candidate from top of sorted list
+        # Matches stay in order, 'current' is the index of the one shown
         match = None
+        current = None
         if len(self.matches) > 0:
-            match = self.matches.pop(0)
+            current = 0
+            match = self.matches[current]
         
         # Keep going until user or Granger decides match is good    
         print()
@@ -911,6 +1201,10 @@ class Audiobook:
                 else:
                     print(colors.OKBLUE + 'Author:   ' + colors.ENDC + 'Unknown Author')
             # Otherwise, no matches have been found
+            elif self.lookup_failed:
+                print(colors.FAIL + 'Lookup failed!' + colors.RESET + ' ')
+                print(colors.OKBLUE + 'Title:')
+                print(colors.OKBLUE + 'Author:')
             else:
                 print(colors.FAIL + 'No matches found!' + colors.RESET + ' ')
                 print(colors.OKBLUE + 'Title:')
@@ -940,11 +1234,13 @@ class Audiobook:
 
                 elif user_input == 'M' or user_input == 'm':
                     print()
-                    if len(self.matches) < 1:
+                    # All matches but the one already shown, still in order
+                    others = [index for index in range(len(self.matches)) if index != current]
+                    if len(others) < 1:
                         print(colors.FAIL + "No more matches!" + colors.RESET + " \n")
                     else:
                         i = 1
-                        for item in self.matches:
+                        for item in (self.matches[index] for index in others):
                             msg = colors.RESET + str(i) + " - "
                             if item["ratio"] >= 0.5:
                                 msg += colors.OKGREEN + "{:.0%}".format(item["ratio"])
@@ -963,19 +1259,18 @@ class Audiobook:
                             i += 1
 
                         selection = -1
-                        while (selection <= 0 or selection > len(self.matches)):
+                        while (selection <= 0 or selection > len(others)):
                             try:
                                 selection = int(input(colors.WARNING + "\nEnter selection:" + colors.RESET + " "))
                             except:
                                 selection = -1
 
-                            if selection < 1 or selection > len(self.matches):
-                                print(colors.FAIL + "Enter number between 1 and " + str(len(self.matches)) + ".")
+                            if selection < 1 or selection > len(others):
+                                print(colors.FAIL + "Enter number between 1 and " + str(len(others)) + ".")
                             
                         # Swap matches
-                        self.matches.append(match)
-                        match = self.matches.pop(selection-1)
-                        self.matches = sorted(self.matches, key = lambda i: i["ratio"], reverse=True) 
+                        current = others[selection-1]
+                        match = self.matches[current]
 
                 elif user_input == 'E' or user_input == 'e':
                     # Do it again with new information
@@ -994,8 +1289,10 @@ class Audiobook:
                     
                     # Update match
                     match = None
+                    current = None
                     if len(self.matches) > 0:
-                        match = self.matches.pop(0)
+                        current = 0
+                        match = self.matches[current]
                         
                 elif user_input == 'N' or user_input == 'n':
                     # Let user set metadata
@@ -1155,91 +1452,231 @@ class Audiobook:
     # Writes tags to audio file 'self'
     # Path to the audio file should be passed to the function
     def write_tags(self):
-        # Write each part of file individually
-        for track, audio_file in enumerate(self.audio_files, 1):
+        # TODO: CLEAR ALL TAGS BEFORE WRITING
 
-            #try:
-            if True:
-                # Get file extension
-                ext = os.path.splitext(audio_file.file_abs_path)[-1]
-        
-                # Open audio file
-                audio = mutagen.File(audio_file.file_abs_path)
+        # TODO: GET .WAV FILES WORKING
+
+        paths = [audio_file.file_abs_path for audio_file in self.audio_files]
+        tags = [self.get_tags(audio_file, track) for track, audio_file in enumerate(self.audio_files, 1)]
+        padding = [config.TAG_PADDING] * len(paths)
+
+        # Write each part of file individually, in worker processes if there
+        # are any. Results come back in track order either way.
+        if process_pool:
+            results = process_pool.map(save_tags, paths, tags, padding)
+        else:
+            results = map(save_tags, paths, tags, padding)
+
+        for audio_file, result in zip(self.audio_files, results):
+            if result is None:
+                logging.critical('Could not write metadata to file. Either corrupt or not an audio file.')
+                audio_file.get_stats()
+                continue
+
+            # Update file stats without opening file again
+            # Writing tags changes the size of a file but not its audio, so
+            # stats we already have are kept
+            stat, probe, padding_counts = result
+            tag_padding.add(*padding_counts)
+            if audio_file.length:
+                probe = Audio_Probe(audio_file.container, audio_file.bitrate, audio_file.length,
+                                    probe.cover, probe.tags)
+            audio_file.update_stats(stat, probe)
+
+
+    # Returns how each file should be brought into the library with
+    # 'import_mode'
+    # Writing tags to a linked file would change the original, so files whose
+    # tags will change are copied (or cloned, where the filesystem can) instead
+    # of linked. Only files whose tags are already right are linked.
+    def get_import_modes(self, import_mode):
+        if import_mode not in ["hardlink", "symlink", "auto"]:
+            return [import_mode] * len(self.audio_files)
+
+        paths = [audio_file.file_abs_path for audio_file in self.audio_files]
+        tags = [self.get_tags(audio_file, track) for track, audio_file in enumerate(self.audio_files, 1)]
+        if process_pool:
+            changes = process_pool.map(tags_changed, paths, tags)
+        else:
+            changes = map(tags_changed, paths, tags)
+
+        import_modes = []
+        for path, changed in zip(paths, changes):
+            if changed:
+                if import_mode != "auto":
+                    logging.warning('Tags of file will change, copying instead of using %s: %s',
+                                    import_mode, os.path.basename(path))
+                import_modes.append("copy")
+            else:
+                import_modes.append(import_mode)
+        return import_modes
+
+
+    # Returns dict of tags 'audio_file' should have as track number 'track'
+    def get_tags(self, audio_file, track):
+        # Get file extension
+        ext = os.path.splitext(audio_file.file_abs_path)[-1]
+
+        # Tags the file should have
+        tags = {}
+
+        # Handle different filetypes separately
+        if ext in [".mp3"]:
+            # Write tags
+            if audio_file.title:
+                tags["title"] = audio_file.title
+            if self.title:
+                tags["album"] = self.title
+            if self.author:
+                tags["artist"] = self.author
+            if self.date_published and self.date_published.year:
+                if self.date_published.year != '0001':
+                    tags["date"] = str(self.date_published.year)
+                else:
+                    tags["date"] = ""
+            if self.genre:
+                tags["genre"] = self.genre
         
-                # TODO: CLEAR ALL TAGS BEFORE WRITING
+            tags["tracknumber"] = str(track)
         
-                # TODO: GET .WAV FILES WORKING
+        elif ext in [".mp4", ".m4a"]:
+            # Write tags
+            if audio_file.title:
+                tags["\xa9nam"] = audio_file.title
+            if self.author:
+                tags["\xa9ART"] = self.author
+            if self.title:
+                tags["\xa9alb"] = self.title
         
-                logging.info('Attempting to open file for writing metadata: %s', audio_file.file_abs_path)
-
-                # Handle different filetypes separately
-                if ext in [".mp3"]:
-                    # Open audio file
-                    try:
-                        audio = EasyID3(audio_file.file_abs_path)
-                    except:
-                        audio = mutagen.File(audio_file.file_abs_path, easy=True)
-                        audio.add_tags()
-                
-                    # Write tags
-                    if audio_file.title:
-                        audio["title"] = audio_file.title
-                    if self.title:
-                        audio["album"] = self.title
-                    if self.author:
-                        audio["artist"] = self.author
-                    if self.date_published and self.date_published.year:
-                        if self.date_published.year != '0001':
-                            audio["date"] = str(self.date_published.year)
-                        else:
-                            audio["date"] = ""
-                    if self.genre:
-                        audio["genre"] = self.genre
-                
-                    audio["tracknumber"] = str(track)
-                
-                elif ext in [".mp4", ".m4a"]:
-                    # Open audio file
-                    audio = MP4(audio_file.file_abs_path)
-                
-                    # Write tags
-                    if audio_file.title:
-                        audio["\xa9nam"] = audio_file.title
-                    if self.author:
-                        audio["\xa9ART"] = self.author
-                    if self.title:
-                        audio["\xa9alb"] = self.title
-                
+        else:
+            # Write tags
+            if audio_file.title:
+                tags["title"] = audio_file.title
+            if self.title:
+                tags["album"] = self.title
+            if self.author:
+                tags["artist"] = self.author
+            if self.publisher:
+                tags["producer"] = self.publisher
+            if self.date_published and self.date_published.year:
+                if self.date_published.year != '0001':
+                    tags["date"] = str(self.date_published.year)
                 else:
-                    # Write tags
-                    if audio_file.title:
-                        audio["title"] = audio_file.title
-                    if self.title:
-                        audio["album"] = self.title
-                    if self.author:
-                        audio["artist"] = self.author
-                    if self.publisher:
-                        audio["producer"] = self.publisher
-                    if self.date_published and self.date_published.year:
-                        if self.date_published.year != '0001':
-                            audio["date"] = str(self.date_published.year)
-                        else:
-                            audio["date"] = ""
-                    if self.description:
-                        audio["description"] = self.description
-                    if self.genre:
-                        audio["genre"] = self.genre
-
-                    audio["tracknumber"] = str(track)
-                
-                # Save changes to file
-                audio.save()
+                    tags["date"] = ""
+            if self.description:
+                tags["description"] = self.description
+            if self.genre:
+                tags["genre"] = self.genre
 
-            #except:
-            else:
-                logging.critical('Could not write metadata to file. Either corrupt or not an audio file.')
+            tags["tracknumber"] = str(track)
+
+        return tags
 
         
+# Audio file opened once for editing tags and reading stats, cover art and
+# tags back afterwards
+class Tag_Session:
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        # Tags that will be changed by save()
+        self.changes = {}
+
+        # MP3 tags are edited through EasyID3, other formats by their own names
+        ext = os.path.splitext(path)[-1]
+        try:
+            self.file = open(path, 'rb')
+            self.audio = mutagen.File(self.file, easy=(ext == ".mp3"))
+        except (OSError, mutagen.MutagenError) as e:
+            logging.error('Could not open audio file %s. Reason: %s', path, e)
+            self.audio = None
+
+    # Set tags from dict of tag names and values, skipping ones the file
+    # already has. Returns dict of tags that changed.
+    def set_tags(self, tags):
+        changes = {key: value for key, value in tags.items() if self.audio.get(key) != [value]}
+        for key, value in changes.items():
+            self.audio[key] = value
+        self.changes.update(changes)
+        return changes
+
+    # Save tags if any were changed, using 'padding' callback
+    def save(self, padding):
+        if self.changes:
+            # Don't write through to the original of a linked file
+            unshare_file(self.path)
+
+            # Open for writing only now, since unsharing may have replaced the
+            # file, and the original may not be writable
+            self.file.close()
+            self.file = open(self.path, 'rb+')
+
+            # Keep padding so the audio after the tags doesn't have to be moved
+            self.audio.save(self.file, padding=padding)
+            self.changes = {}
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+# Write tags to audio file at 'path', leaving 'padding' bytes of padding if the
+# tags don't fit
+# Only plain values go in and out, so it can run in a worker process, and
+# nothing shared (like the stat cache) is touched
+# Returns (os.stat() result, Audio_Probe of file, (saves, rewrites, bytes moved)
+# for Tag_Padding), or None if file could not be opened
+def save_tags(path, tags, padding):
+    logging.info('Attempting to open file for writing metadata: %s', path)
+
+    # Open audio file once for both tags and stats
+    session = Tag_Session(path)
+    try:
+        if session.audio is None:
+            return None
+
+        # Only write tags that are different from the ones in the file
+        if not session.set_tags(tags):
+            logging.info('Tags already up to date: %s', os.path.basename(path))
+
+        # Save changes to file
+        counts = Tag_Padding(padding)
+        session.save(counts)
+
+        # Cover art may have moved within the file, and tags have changed
+        # Mutagen doesn't keep where things are in the file, so the headers are
+        # read back through the file it was saved with
+        probe = mutagen_stats(session.audio)
+        native = probe_file(session.file, path)
+        if native:
+            probe.cover = native.cover
+            probe.tags = native.tags
+
+        return os.fstat(session.file.fileno()), probe, (counts.saves, counts.rewrites, counts.bytes_moved)
+    finally:
+        session.close()
+
+
+# Returns whether writing 'tags' to audio file at 'path' would change it
+# Like save_tags(), this can run in a worker process
+def tags_changed(path, tags):
+    session = Tag_Session(path)
+    try:
+        if session.audio is None:
+            return False
+        return bool(session.set_tags(tags))
+    finally:
+        session.close()
+
+
+# Runs in each worker process before it is given any work
+def setup_worker(log_level):
+    logging.basicConfig(filename='granger.log', format='[%(asctime)s] %(process)d: %(message)s', level=log_level)
+    # Leave Ctrl-C to the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
 # This is the class that contains a file that is part of an Audiobook
 class Audio_File:
     file_abs_path = ""
@@ -1247,6 +1684,12 @@ class Audio_File:
     size = 0
     bitrate = 0
     length = 0.0
+    # Type of audio container, as named by mutagen
+    container = ""
+    # (offset, length, MIME type) of embedded cover art, if any
+    cover = None
+    # Title, album, artist, albumartist, isbn and asin already in the file
+    tags = {}
     # List of all high-level parts contained in this audio file
     high_parts = []
     # List of all chapters contained in this audio file
@@ -1262,8 +1705,11 @@ class Audio_File:
         self.chapters = []
         self.low_parts = []
 
-    def __init__(self, location):
+    def __init__(self, location, stat=None):
         self.file_abs_path = location
+        # os.stat() result from when file was found, used instead of statting
+        # the file again the first time its stats are needed
+        self.found_stat = stat
         self.title = os.path.splitext(os.path.basename(self.file_abs_path))[0]
         self.high_parts = []
         self.chapters = []
@@ -1311,45 +1757,41 @@ class Audio_File:
                 self.title += " - Parts " + self.low_parts[0] + "-" + self.low_parts[-1]
         
         
-    # Get file stats
+    # Get file stats (size, container, bitrate and length)
     def get_stats(self):
-        self.size = os.path.getsize(self.file_abs_path)
+        stat = self.get_cached_stats()
+        if stat:
+            # Only headers are read, the file is never written to
+            logging.info('Attempting to open file for reading info: %s', os.path.basename(self.file_abs_path))
+            self.update_stats(stat, probe_audio(self.file_abs_path))
 
-        # Get file extension
-        ext = os.path.splitext(self.file_abs_path)[-1]
-        
-        # Open audio file
-        audio = None        
-        logging.info('Attempting to open file for reading info: %s', os.path.basename(self.file_abs_path))
 
-        # Handle different filetypes separately
-        if ext in [".mp3"]:
-            # Open audio file
-            try:
-                audio = EasyID3(self.file_abs_path)
-            except:
-                audio = mutagen.File(self.file_abs_path, easy=True)
-                audio.add_tags()
-                
-        elif ext in [".mp4", ".m4a"]:
-            # Open audio file
-            audio = MP4(self.file_abs_path)
+    # Get file stats from stat cache if file hasn't changed since we last saw it
+    # Returns os.stat() result if file still has to be probed, otherwise None
+    def get_cached_stats(self):
+        stat = self.found_stat or os.stat(self.file_abs_path)
+        self.found_stat = None
+        self.size = stat.st_size
 
-        else:
-            audio = mutagen.File(self.file_abs_path)
-                
-        try:
-            self.bitrate = audio.info.bitrate
-        except:
-            self.bitrate = 0
-            
-        try:
-            self.length = audio.info.length
-        except:
-            self.length = 0
+        if stat_cache:
+            cached = stat_cache.get(stat)
+            if cached:
+                self.container, self.bitrate, self.length, self.cover, self.tags = cached
+                return None
+        return stat
 
-        # Save changes to file
-        audio.save()
+
+    # Update file stats from os.stat() result and Audio_Probe of file
+    def update_stats(self, stat, probe):
+        self.size = stat.st_size
+        self.container = probe.container
+        self.bitrate = probe.bitrate
+        self.length = probe.length
+        self.cover = probe.cover
+        self.tags = probe.tags
+
+        if stat_cache:
+            stat_cache.put(stat, self.container, self.bitrate, self.length, self.cover, self.tags)
 
 
     # Uses the file_abs_path to get parts and chapters for organizing
@@ -1432,32 +1874,1957 @@ class Audio_File:
             self.low_parts = [ low_part_num ]
 
 
+# Client for the Google Books API
+# A single client is shared by all threads so connections are kept alive and
+# reused between lookups
+class Google_Books_Client:
+
+    URL = "https://www.googleapis.com/books/v1/volumes"
+
+    # Only ask for the fields that select_info uses
+    FIELDS = ("items/volumeInfo(title,subtitle,authors,publisher,categories,publishedDate,"
+              "description,industryIdentifiers,maturityRating,averageRating)")
+
+    # Responses that mean we are going too fast or Google is having trouble
+    RETRY_STATUS = [403, 429, 500, 502, 503, 504]
+
+    def __init__(self, cache=None, refresh=False, max_connections=10, limiter=None):
+        # Search_Cache to check before searching, if any
+        self.cache = cache
+        # Rate_Limiter every request has to go through, if any
+        self.limiter = limiter
+        # Skip cached results, but still store the new ones
+        self.refresh = refresh
+
+        # Keep-alive connection pool, large enough for every worker thread
+        self.session = requests.Session()
+        self.session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=max_connections))
+
+        # Google only compresses responses if the user agent mentions gzip
+        self.session.headers.update({'Accept-Encoding': 'gzip',
+                                     'User-Agent': 'Granger/' + __version__ + ' (gzip)'})
+
+    # Search Google Books and return list of raw items
+    # Raises Lookup_Error if 'deadline' (from time.monotonic()) passes or the
+    # 'cancel' event is set before the search is done
+    def search(self, search_term, deadline=None, cancel=None):
+        # Use cached results if we have searched this before
+        if self.cache and not self.refresh:
+            items = self.cache.get(search_term)
+            if items is not None:
+                logging.info('Using cached results for search term: %s', search_term)
+                return items
+
+        params = {'q': search_term,
+                  'maxResults': config.MAX_RESULTS,
+                  'fields': self.FIELDS}
+        if config.GOOGLE_API_KEY:
+            params['key'] = config.GOOGLE_API_KEY
+
+        # Retry with exponential backoff if Google asks us to slow down
+        for attempt in range(config.MAX_RETRIES + 1):
+            if self.limiter:
+                self.limiter.acquire(True, deadline, cancel)
+
+            delay = None
+            try:
+                response = self.session.get(self.URL, params=params, timeout=request_timeout(deadline))
+            except requests.exceptions.RequestException as e:
+                error = str(e)
+            else:
+                if response.ok:
+                    break
+                error = 'HTTP ' + str(response.status_code)
+                if response.status_code not in self.RETRY_STATUS:
+                    raise Lookup_Error(error)
+                delay = parse_retry_after(response.headers.get('Retry-After'))
+                # Don't let the server hold every thread for as long as it
+                # likes
+                if delay is not None:
+                    delay = min(config.MAX_BACKOFF, delay)
+
+            if attempt == config.MAX_RETRIES:
+                raise Lookup_Error(error)
+
+            # Honor 'Retry-After' if given, otherwise back off exponentially
+            if delay is None:
+                delay = min(config.MAX_BACKOFF, 2 ** attempt) + random.random()
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise Lookup_Error(error + ', no time left to retry')
+            logging.warning('Google Books request failed (%s), retrying in %.1f seconds', error, delay)
+
+            # Pausing the limiter slows down every thread, not just this one
+            if self.limiter:
+                self.limiter.pause(delay)
+            elif cancel:
+                if cancel.wait(delay):
+                    raise Lookup_Error('Cancelled')
+            else:
+                time.sleep(delay)
+
+        # Make JSON response readable
+        response = response.json()
+        items = response.get("items", [])
+
+        # Store raw items so they can be re-scored later without a search
+        if self.cache and "error" not in response:
+            self.cache.put(search_term, items)
+
+        return items
+
+
+# Raised when Google Books can not be searched, as opposed to finding nothing
+class Lookup_Error(Exception):
+    pass
+
+
+# Token bucket shared by all outbound requests
+# Allows 'burst' requests at once, refilling at 'rate' requests per second. A
+# daily quota counter is kept on disk so batch imports spread over several runs
+# still pace themselves instead of failing halfway.
+class Rate_Limiter:
+
+    # Seconds between writes of the daily quota counter
+    QUOTA_SAVE_INTERVAL = 30
+
+    def __init__(self, rate, burst, daily_quota=0, quota_location=None):
+        # Requests per second, 0 for no limit
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        # Nobody makes requests before this time, set while backing off
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+        # Requests allowed per day, 0 for no limit
+        self.daily_quota = daily_quota
+        self.quota_location = quota_location
+        self.quota_date = str(datetime.date.today())
+        self.quota_count = 0
+        # When quota counter was last written, it is also written on close()
+        self.quota_saved = time.monotonic()
+        if quota_location and os.path.isfile(quota_location):
+            try:
+                with open(quota_location) as f:
+                    quota = json.load(f)
+                if quota['date'] == self.quota_date:
+                    self.quota_count = quota['count']
+            except (ValueError, KeyError, OSError) as e:
+                logging.warning('Could not read quota file %s. Reason: %s', quota_location, e)
+
+    # Block until a request can be made
+    # Requests with 'quota' set count towards the daily quota. Raises
+    # Lookup_Error if the request can't be made before 'deadline' or 'cancel'
+    # event is set while waiting.
+    def acquire(self, quota=False, deadline=None, cancel=None):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                wait = self.paused_until - now
+                waiting_for_quota = False
+
+                # Start counting again on a new day
+                today = str(datetime.date.today())
+                if today != self.quota_date:
+                    self.quota_date = today
+                    self.quota_count = 0
+
+                # Out of requests for today, wait for tomorrow
+                if wait <= 0 and quota and self.daily_quota and self.quota_count >= self.daily_quota:
+                    tomorrow = datetime.datetime.combine(datetime.date.today() + datetime.timedelta(days=1),
+                                                         datetime.time())
+                    wait = (tomorrow - datetime.datetime.now()).total_seconds()
+                    waiting_for_quota = True
+                    logging.warning('Daily quota of %d requests used up, waiting %d seconds',
+                                    self.daily_quota, wait)
+
+                if wait <= 0:
+                    # Refill bucket
+                    if self.rate:
+                        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                        self.updated = now
+                    else:
+                        self.tokens = self.burst
+
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        if quota:
+                            self.quota_count += 1
+                            if now - self.quota_saved >= self.QUOTA_SAVE_INTERVAL:
+                                self.save_quota()
+                        return
+
+                    wait = (1 - self.tokens) / self.rate
+
+            # Waiting out the daily quota is on purpose, so it is not bound by
+            # the deadline
+            if deadline is not None and not waiting_for_quota and now + wait > deadline:
+                raise Lookup_Error('Deadline exceeded while waiting to send request')
+            if cancel:
+                if cancel.wait(wait):
+                    raise Lookup_Error('Cancelled')
+            else:
+                time.sleep(wait)
+
+    # Stop all requests for a number of seconds
+    # Requests made after this wait in acquire()
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    # Write daily quota counter to disk, should be called before exiting
+    def close(self):
+        with self.lock:
+            self.save_quota()
+
+    # Write daily quota counter to disk
+    # Should only be called while holding lock
+    def save_quota(self):
+        self.quota_saved = time.monotonic()
+        if not self.quota_location:
+            return
+        try:
+            directory = os.path.dirname(self.quota_location)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.quota_location, 'w') as f:
+                json.dump({'date': self.quota_date, 'count': self.quota_count}, f)
+        except OSError as e:
+            logging.warning('Could not write quota file %s. Reason: %s', self.quota_location, e)
+
+
+# Persistent cache of Google Books search results
+# The raw 'items' payload is stored by normalized search term, so matches can be
+# re-scored against cached data without touching the network
+class Search_Cache:
+
+    def __init__(self, location, ttl, max_entries):
+        # Seconds before an entry expires, 0 to never expire
+        self.ttl = ttl
+        # Maximum number of entries kept, least recently used are evicted first
+        self.max_entries = max_entries
+
+        # Make sure cache directory exists
+        directory = os.path.dirname(location)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Connection is shared between threads, so all access goes through lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(location, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS searches ('
+                                    'term TEXT PRIMARY KEY, '
+                                    'items TEXT NOT NULL, '
+                                    'created REAL NOT NULL, '
+                                    'accessed REAL NOT NULL)')
+
+    # Searches that only differ in case or spacing share an entry
+    @staticmethod
+    def normalize(search_term):
+        return ' '.join(search_term.lower().split())
+
+    # Returns cached list of items, or None if not cached or expired
+    def get(self, search_term):
+        term = self.normalize(search_term)
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT items, created FROM searches WHERE term = ?',
+                                          (term,)).fetchone()
+            if row is None:
+                return None
+
+            # Drop expired entry
+            if self.ttl and now - row[1] > self.ttl:
+                logging.debug('Cached search expired: %s', term)
+                self.connection.execute('DELETE FROM searches WHERE term = ?', (term,))
+                return None
+
+            # Mark as recently used
+            self.connection.execute('UPDATE searches SET accessed = ? WHERE term = ?', (now, term))
+
+        return json.loads(row[0])
+
+    # Store list of items for search term, evicting old entries if cache is full
+    def put(self, search_term, items):
+        term = self.normalize(search_term)
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO searches VALUES (?, ?, ?, ?)',
+                                    (term, json.dumps(items), now, now))
+            if self.max_entries:
+                self.connection.execute('DELETE FROM searches WHERE term IN '
+                                        '(SELECT term FROM searches ORDER BY accessed DESC '
+                                        'LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+
+# Cleans up file names and search results for searching and comparing
+# Everything is built once from config, so cleaning a string takes a few passes
+# of precompiled regexes and translation tables instead of a loop per word
+class Normalizer:
+
+    # Website names left in file names by download sites
+    WEBSITE_DOMAINS = ["com", "net", "org", "io", "cc"]
+
+    # Chapter and part identifiers, removed from group keys
+    IDENTIFIERS = ["part", "pt", "prt", "chap", "chapt", "chapter", "cpt", "chpt"]
+
+    # Word IDs are word hashes cut to 62 bits, where collisions between the few
+    # words of two titles are practically impossible
+    TOKEN_MASK = (1 << 62) - 1
+
+    def __init__(self, words, spec_chars):
+        self.part_regex = re.compile(Audio_File.PART_FINDER_REGEX_STRING)
+        self.website_regex = re.compile("[^a-z0-9][a-z0-9]*\\.(?:" + "|".join(self.WEBSITE_DOMAINS) + ")")
+
+        # Longest first, so 'audiobooks' is removed rather than leaving the 's'
+        self.words_regex = re.compile("|".join(re.escape(word) for word in
+                                               sorted(words, key=len, reverse=True)))
+        self.identifiers_regex = re.compile("|".join(sorted(self.IDENTIFIERS, key=len, reverse=True)))
+        self.non_alpha_regex = re.compile(r"[^a-z]+")
+
+        # Special characters are all replaced by spaces
+        self.spec_chars_table = str.maketrans({char: ' ' for char in spec_chars})
+
+        # Title and author formatting
+        self.punctuation_regex = re.compile(r'([\.,!?;:-])(?=[^ \.,!?;:\-$])')
+        self.initials_regex = re.compile(r'(.\.)(?=[^ ])')
+        self.spaced_initials_regex = re.compile(r'(?<=[^a-zA-Z])?([A-Z])([ ])')
+
+    # Turn file name into search term
+    # Returns search term, and whether file seems to be an excerpt
+    def search_term(self, filename):
+        search_term = os.path.splitext(os.path.basename(filename))[0]
+
+        # Remove part and chapter numbers
+        search_term = self.part_regex.sub('', search_term)
+
+        # Use only lower-case letters for simplicity
+        search_term = search_term.lower()
+
+        # Find and remove website names
+        search_term = self.website_regex.sub('', search_term)
+
+        # Check if file is an excerpt
+        is_excerpt = "excerpt" in search_term
+        if is_excerpt:
+            search_term = search_term.replace("excerpt", '')
+
+        # Remove unhelpful words and special characters
+        search_term = self.words_regex.sub(' ', search_term)
+        search_term = search_term.translate(self.spec_chars_table)
+        return search_term, is_excerpt
+
+    # Lower case text without special characters, for comparing
+    def clean(self, text):
+        return text.lower().translate(self.spec_chars_table)
+
+    # Set of IDs of the words in text, once cleaned
+    # IDs are hashes of the words, so nothing has to be kept for every word
+    # ever seen. Results are remembered, since the same titles come back in
+    # many searches.
+    @functools.lru_cache(maxsize=16384)
+    def tokens(self, text):
+        return frozenset(hash(word) & self.TOKEN_MASK for word in self.clean(text).split())
+
+    # Reduce filename to the part that is the same for all files in a book
+    def group_key(self, filename):
+        # Use only lower case, remove all non-alpha characters
+        key = self.non_alpha_regex.sub("", filename.lower())
+
+        # Remove chapter and part identifiers
+        return self.identifiers_regex.sub("", key)
+
+    # Make sure there is a space after any punctuation in the title and fix
+    # capitalization
+    @functools.lru_cache(maxsize=4096)
+    def format_title(self, title):
+        return titleify(self.punctuation_regex.sub(r'\1 ', title))
+
+    # Make sure initials are formatted like "J. R. R. Tolkien" and fix
+    # capitalization
+    @functools.lru_cache(maxsize=4096)
+    def format_author(self, author):
+        # If author is formatted like "J.R.R. Tolkien", replace with "J. R. R. Tolkien"
+        author = self.initials_regex.sub(r'\1 ', author)
+        # If author is formatted like "J R R Tolkien", replace with "J. R. R. Tolkien"
+        author = self.spaced_initials_regex.sub(r'\1.\2', author)
+        return titleify(author)
+
+
+# Groups files that belong to the same book
+# Each filename is reduced to a key once, so finding files with the same key is
+# a dict lookup. Names in the same directory that are only nearly the same, like
+# typos or stray tags, can also be matched by setting 'similarity' to the lowest
+# Jaccard similarity allowed between their keys. Those are found through MinHash
+# signatures split into LSH bands, so a new name is only compared with a few
+# likely groups instead of all of them.
+class File_Grouper:
+
+    # Length of character shingles compared for near matches
+    SHINGLE_LENGTH = 3
+    # Signature is split into BANDS bands of ROWS hashes. Keys sharing any band
+    # are compared, which catches most pairs above about 50% similarity.
+    BANDS = 8
+    ROWS = 2
+    # Large prime for hash permutations
+    PRIME = (1 << 61) - 1
+
+    def __init__(self, similarity=0.0):
+        # Lowest similarity for near matches, 0 to only group exact matches
+        self.similarity = similarity
+        # Lists of similar filenames, in the order they were found
+        self.groups = []
+        # Index into 'groups' by key
+        self.keys = {}
+        # Indexes into 'groups' by (directory key, band number, band of signature)
+        self.buckets = collections.defaultdict(list)
+        # Shingles of the first name of each group, for checking near matches
+        self.shingles = []
+
+        # Hash functions for MinHash signatures, same for every run
+        self.hash_functions = self.get_hash_functions(self.BANDS * self.ROWS, self.PRIME)
+
+    # A grouper is made for every directory, so hash functions are only made
+    # once
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def get_hash_functions(count, prime):
+        generator = random.Random(0)
+        return [(generator.randrange(1, prime), generator.randrange(prime)) for i in range(count)]
+
+    # Reduce filename to the part that is the same for all files in a book
+    @staticmethod
+    def key(filename):
+        return normalizer.group_key(filename)
+
+    # Add filename to the group it belongs to, creating a new group if needed
+    # Returns index of group in 'groups'
+    def add(self, filename):
+        key = self.key(filename)
+        index = self.keys.get(key)
+        if index is not None:
+            self.groups[index].append(filename)
+            return index
+
+        shingles = None
+        if self.similarity:
+            # Only compare names, files in other directories are never near
+            # matches
+            directory, name = os.path.split(filename)
+            shingles = self.get_shingles(self.key(name))
+            bands = self.get_bands(self.key(directory), shingles)
+            index = self.find_similar(shingles, bands)
+
+        if index is None:
+            # Filename doesn't match any other books, create a new one
+            index = len(self.groups)
+            self.groups.append([])
+            self.shingles.append(shingles)
+            if self.similarity:
+                for band in bands:
+                    self.buckets[band].append(index)
+        else:
+            logging.debug('Grouped near match: %s', os.path.basename(filename))
+
+        self.keys[key] = index
+        self.groups[index].append(filename)
+        return index
+
+    # Set of hashed character shingles of key
+    def get_shingles(self, key):
+        if len(key) <= self.SHINGLE_LENGTH:
+            return {hash(key)}
+        return {hash(key[i:i+self.SHINGLE_LENGTH]) for i in range(len(key) - self.SHINGLE_LENGTH + 1)}
+
+    # MinHash signature of shingles, split into bands for bucketing
+    def get_bands(self, directory_key, shingles):
+        signature = [min((a * shingle + b) % self.PRIME for shingle in shingles)
+                     for a, b in self.hash_functions]
+        return [(directory_key, band, tuple(signature[band*self.ROWS:(band+1)*self.ROWS]))
+                for band in range(self.BANDS)]
+
+    # Returns index of most similar group sharing a band, or None
+    def find_similar(self, shingles, bands):
+        best = None
+        best_similarity = self.similarity
+        checked = set()
+        for band in bands:
+            for index in self.buckets.get(band, []):
+                if index in checked:
+                    continue
+                checked.add(index)
+                other = self.shingles[index]
+                similarity = len(shingles & other) / len(shingles | other)
+                if similarity >= best_similarity:
+                    best = index
+                    best_similarity = similarity
+        return best
+
+
+# Persistent cache of audio file stats
+# Files are identified by device, inode, size and modification time, so a file
+# that hasn't changed never has to be parsed again
+class Stat_Cache:
+
+    def __init__(self, location, max_entries):
+        # Number of lookups that were and weren't cached, for logging
+        self.hits = 0
+        self.misses = 0
+
+        # Make sure cache directory exists
+        directory = os.path.dirname(location)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Connection is shared between threads, so all access goes through lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(location, check_same_thread=False)
+        with self.lock, self.connection:
+            # Losing the last few entries on a crash is fine for a cache
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+
+            # Entries from before cover art and tags were cached would say
+            # files have none, so start over
+            columns = [row[1] for row in self.connection.execute('PRAGMA table_info(stats)')]
+            if columns and 'tags' not in columns:
+                self.connection.execute('DROP TABLE stats')
+
+            self.connection.execute('CREATE TABLE IF NOT EXISTS stats ('
+                                    'device INTEGER NOT NULL, '
+                                    'inode INTEGER NOT NULL, '
+                                    'size INTEGER NOT NULL, '
+                                    'mtime INTEGER NOT NULL, '
+                                    'container TEXT NOT NULL, '
+                                    'bitrate INTEGER NOT NULL, '
+                                    'length REAL NOT NULL, '
+                                    'cover_offset INTEGER, '
+                                    'cover_length INTEGER, '
+                                    'cover_type TEXT, '
+                                    'tags TEXT NOT NULL, '
+                                    'PRIMARY KEY (device, inode, size, mtime))')
+
+            # Drop oldest entries once cache is full, once per run is enough
+            if max_entries:
+                self.connection.execute('DELETE FROM stats WHERE rowid IN '
+                                        '(SELECT rowid FROM stats ORDER BY rowid DESC '
+                                        'LIMIT -1 OFFSET ?)', (max_entries,))
+
+    # Takes os.stat() result and returns (container, bitrate, length, cover,
+    # tags), or None if file is not cached
+    # 'cover' is (offset, length, MIME type) of embedded cover art, or None
+    def get(self, stat):
+        with self.lock:
+            row = self.connection.execute('SELECT container, bitrate, length, '
+                                          'cover_offset, cover_length, cover_type, tags FROM stats '
+                                          'WHERE device = ? AND inode = ? AND size = ? AND mtime = ?',
+                                          (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)).fetchone()
+            if row:
+                self.hits += 1
+            else:
+                self.misses += 1
+                return None
+        cover = row[3:6] if row[3] is not None else None
+        return row[0], row[1], row[2], cover, json.loads(row[6])
+
+    def put(self, stat, container, bitrate, length, cover=None, tags=None):
+        cover = cover or (None, None, None)
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                    (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+                                     container, int(bitrate), length) + tuple(cover) + (json.dumps(tags or {}),))
+
+
+# Persistent index of the authors, books and files in the library
+# Lets existing books be found and compared without crawling the library or
+# re-reading every file
+class Library_Index:
+
+    def __init__(self, location):
+        # Set if index did not exist before and still needs to be filled
+        self.created = not os.path.isfile(location)
+
+        # Make sure index directory exists
+        directory = os.path.dirname(location)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Connection is shared between threads, so all access goes through lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(location, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS authors ('
+                                    'name TEXT PRIMARY KEY, '
+                                    'directory TEXT NOT NULL)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS books ('
+                                    'id INTEGER PRIMARY KEY, '
+                                    'author TEXT NOT NULL, '
+                                    'title TEXT NOT NULL, '
+                                    'directory TEXT NOT NULL, '
+                                    'UNIQUE (author, title))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS files ('
+                                    'path TEXT PRIMARY KEY, '
+                                    'book INTEGER NOT NULL REFERENCES books(id), '
+                                    'size INTEGER NOT NULL, '
+                                    'bitrate INTEGER NOT NULL, '
+                                    'length REAL NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS files_book ON files (book)')
+
+
+    def has_author(self, name):
+        with self.lock:
+            row = self.connection.execute('SELECT 1 FROM authors WHERE name = ?', (name,)).fetchone()
+        return row is not None
+
+
+    def add_author(self, name, directory):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO authors VALUES (?, ?)', (name, directory))
+
+
+    # Returns Audiobook with stats of existing book, or None if not in library
+    def get_book(self, author, title):
+        with self.lock:
+            row = self.connection.execute('SELECT id, directory FROM books WHERE author = ? AND title = ?',
+                                          (author, title)).fetchone()
+            if row is None:
+                return None
+            files = self.connection.execute('SELECT path, size, bitrate, length FROM files '
+                                            'WHERE book = ? ORDER BY path', (row[0],)).fetchall()
+
+        # Book was removed from library behind our back
+        if not os.path.isdir(row[1]):
+            logging.info('Indexed book no longer exists: %s', row[1])
+            with self.lock, self.connection:
+                self.connection.execute('DELETE FROM files WHERE book = ?', (row[0],))
+                self.connection.execute('DELETE FROM books WHERE id = ?', (row[0],))
+            return None
+
+        book = Audiobook()
+        book.title = title
+        book.author = author
+        book.directory = row[1]
+        for path, size, bitrate, length in files:
+            audio_file = Audio_File(path)
+            audio_file.size = size
+            audio_file.bitrate = bitrate
+            audio_file.length = length
+            book.audio_files.append(audio_file)
+        book.sum_stats()
+        return book
+
+
+    # Record book and the stats of all of its files, replacing what was there
+    def add_book(self, author, book):
+        with self.lock, self.connection:
+            self.add_book_rows(author, book.title, book.directory, book.audio_files)
+
+
+    # Insert rows for book, should only be called while holding lock inside a
+    # transaction
+    def add_book_rows(self, author, title, directory, audio_files):
+        row = self.connection.execute('SELECT id FROM books WHERE author = ? AND title = ?',
+                                      (author, title)).fetchone()
+        if row:
+            book_id = row[0]
+            self.connection.execute('DELETE FROM files WHERE book = ?', (book_id,))
+            self.connection.execute('UPDATE books SET directory = ? WHERE id = ?', (directory, book_id))
+        else:
+            book_id = self.connection.execute('INSERT INTO books (author, title, directory) VALUES (?, ?, ?)',
+                                              (author, title, directory)).lastrowid
+        self.connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)',
+                                    [(audio_file.file_abs_path, book_id, audio_file.size,
+                                      int(audio_file.bitrate), audio_file.length)
+                                     for audio_file in audio_files])
+
+
+    # Replace index with what is currently in library
+    # Assumes structure of /path/to/library/author/book/book.ogg
+    def rebuild(self, base_dir, workers):
+
+        # Find all books of an author and get the stats of their files
+        def scan_author(author_dir):
+            books = []
+            with os.scandir(author_dir) as book_entries:
+                for book_entry in book_entries:
+                    if not book_entry.is_dir():
+                        continue
+                    audio_files = []
+                    with os.scandir(book_entry.path) as file_entries:
+                        for file_entry in file_entries:
+                            if file_entry.is_file() and os.path.splitext(file_entry.name)[-1] in FORMATS:
+                                audio_file = Audio_File(file_entry.path)
+                                audio_file.get_stats()
+                                audio_files.append(audio_file)
+                    books.append((book_entry.name, book_entry.path, audio_files))
+            return books
+
+        with os.scandir(base_dir) as entries:
+            authors = [(entry.name, entry.path) for entry in entries if entry.is_dir()]
+
+        # Scan authors in parallel, most of the time is spent waiting on disk
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            scanned = list(executor.map(lambda author: scan_author(author[1]), authors))
+
+        # Swap out whole index at once
+        num_books = 0
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM files')
+            self.connection.execute('DELETE FROM books')
+            self.connection.execute('DELETE FROM authors')
+            for (name, directory), books in zip(authors, scanned):
+                self.connection.execute('INSERT INTO authors VALUES (?, ?)', (name, directory))
+                for title, book_dir, audio_files in books:
+                    self.add_book_rows(name, title, book_dir, audio_files)
+                    num_books += 1
+        self.created = False
+
+        logging.info('Indexed %d authors and %d books', len(authors), num_books)
+
+
+# Writes books to the library with separate workers for every pair of input and
+# library disks, so a slow disk doesn't hold up the others and no disk gets more
+# parallel writes than it can take
+class Write_Scheduler:
+
+    def __init__(self, library, import_mode, workers):
+        self.library = library
+        self.import_mode = import_mode
+        # Number of books read from each input disk, and written to each
+        # library disk, at once
+        self.workers = max(1, workers)
+        # Books waiting to be written, for each (input device, library device)
+        self.queues = {}
+        # Slots for books being written, for each library device, shared by
+        # the workers of every input disk
+        self.slots = {}
+        self.threads = []
+        # Keeps books of the same size in the order they were selected
+        self.counter = itertools.count()
+        self.library_device = os.stat(library.base_dir).st_dev
+
+    # Queue book to be written by the workers for its disks
+    def submit(self, book):
+        try:
+            devices = (os.stat(book.audio_files[0].file_abs_path).st_dev, self.library_device)
+        except OSError as e:
+            logging.error('Failed to add book to library: %s. Reason: %s', book.title, e)
+            book.release_images()
+            return
+
+        # Start workers for disks we haven't seen yet
+        if devices not in self.queues:
+            logging.info('Starting %d write workers for devices %d -> %d', self.workers, *devices)
+            self.queues[devices] = queue.PriorityQueue()
+            slots = self.slots.setdefault(devices[1], threading.BoundedSemaphore(self.workers))
+            for i in range(self.workers):
+                thread = threading.Thread(target=self.worker, args=(self.queues[devices], slots))
+                thread.start()
+                self.threads.append(thread)
+
+        # Biggest books are written first
+        self.queues[devices].put((-book.size, next(self.counter), book))
+
+    # Wait for all queued books to be written
+    def close(self):
+        # 'None' messages sort after every book
+        for books in self.queues.values():
+            for i in range(self.workers):
+                books.put((float('inf'), next(self.counter), None))
+        for thread in self.threads:
+            thread.join()
+
+    def worker(self, books, slots):
+        while True:
+            size, count, book = books.get()
+            # Stop after the book we are working on if told to
+            if book is None or write_cancel.is_set():
+                break
+            try:
+                # Wait for the library disk to have room for another book
+                with slots:
+                    self.library.add_book(book, self.import_mode)
+            except Exception as e:
+                logging.error('Failed to add book to library: %s. Reason: %s', book.title, e)
+            finally:
+                book.release_images()
+
+
+# Image kept in memory, or in the image store, until it is written into the
+# library
+class Image:
+
+    def __init__(self, data, extension, path=None, offset=None, length=None):
+        self.data = data
+        # File extension, including the dot
+        self.extension = extension
+        # File image can be read from, like its place in the image store
+        self.path = path
+        # Where image is in that file, if it is only part of it (like cover
+        # art embedded in an audio file)
+        self.offset = offset
+        self.length = length
+
+    # Write image to 'location' with extension added, returns full path
+    # Stored images are linked rather than written again
+    def save(self, location):
+        destination = location + self.extension
+
+        # Old image may be linked to the store, so never write over it
+        if os.path.lexists(destination):
+            os.remove(destination)
+
+        # Copy image out of the file it is part of, without reading it in
+        if self.path and self.offset is not None:
+            with open(self.path, 'rb') as fsrc, open(destination, 'wb') as fdst:
+                kernel_copy(fsrc, fdst, self.length, self.offset)
+            return destination
+
+        if self.path:
+            try:
+                os.link(self.path, destination)
+                return destination
+            except OSError as e:
+                logging.debug('Could not link stored image %s. Reason: %s', self.path, e)
+                if self.data is None:
+                    copy_file(self.path, destination)
+                    return destination
+
+        with open(destination, 'wb') as f:
+            f.write(self.data)
+        return destination
+
+
+# Images found for search terms, kept between runs
+# Image files are named after the SHA-256 of their contents, so an image found
+# for several search terms (like the same cover for different editions) is only
+# kept once, and is hard linked into the library wherever it is used
+# Search terms that found nothing are remembered for a shorter time, so they
+# aren't searched for on every run
+class Image_Store:
+
+    def __init__(self, directory, ttl, miss_ttl):
+        self.directory = directory
+        # Seconds before found and not found entries expire, 0 to never expire
+        self.ttl = ttl
+        self.miss_ttl = miss_ttl
+
+        # Make sure store directory exists
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # Connection is shared between threads, so all access goes through lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(directory, 'images.db'), check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS images ('
+                                    'term TEXT PRIMARY KEY, '
+                                    'hash TEXT, '
+                                    'extension TEXT, '
+                                    'created REAL NOT NULL)')
+
+    # Returns location of image file with SHA-256 'digest'
+    def location(self, digest, extension):
+        return os.path.join(self.directory, digest[:2], digest + extension)
+
+    # Returns (True, Image or None if nothing was found) if search term is
+    # stored, otherwise (False, None)
+    def get(self, search_term):
+        term = Search_Cache.normalize(search_term)
+        now = time.time()
+        with self.lock, self.connection:
+            row = self.connection.execute('SELECT hash, extension, created FROM images WHERE term = ?',
+                                          (term,)).fetchone()
+            if row is None:
+                return False, None
+            digest, extension, created = row
+
+            # Drop expired entry
+            ttl = self.ttl if digest else self.miss_ttl
+            if ttl and now - created > ttl:
+                self.connection.execute('DELETE FROM images WHERE term = ?', (term,))
+                return False, None
+
+        if not digest:
+            return True, None
+
+        # Image file may have been cleaned out of the store
+        path = self.location(digest, extension)
+        if not os.path.isfile(path):
+            return False, None
+        return True, Image(None, extension, path)
+
+    # Store image found for search term, or None if nothing was found
+    def put(self, search_term, image):
+        term = Search_Cache.normalize(search_term)
+        digest = None
+        extension = None
+        if image:
+            digest = hashlib.sha256(image.data).hexdigest()
+            extension = image.extension
+            path = self.location(digest, extension)
+
+            # Write new images under a temporary name, so a half written file
+            # is never mistaken for a whole one
+            # Other runs may be writing the same image, so the name includes
+            # the process as well as the thread
+            if not os.path.isfile(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident())
+                try:
+                    with open(temp_path, 'wb') as f:
+                        f.write(image.data)
+                    os.replace(temp_path, path)
+                except OSError:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    raise
+            image.path = path
+
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?)',
+                                    (term, digest, extension, time.time()))
+
+
+# Looks for images in the background, so they are ready when they are needed
+# Images for the same search term are only looked for once. Every book that
+# prefetched an image lets go of it with discard() once it has been written or
+# skipped, and images nobody needs anymore are dropped, or cancelled if they
+# haven't started yet.
+class Image_Prefetcher:
+
+    def __init__(self, workers, library_dir):
+        self.library_dir = library_dir
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        # Search term -> [future of Image, number of books waiting for it]
+        self.images = {}
+        self.lock = threading.Lock()
+
+    # Start looking for images for book with 'title' by 'author'
+    # Cover image is only looked for if 'cover' is set, and author image only
+    # if the author is new to the library
+    # Returns list of search terms started
+    def prefetch(self, title, author, cover=True):
+        search_terms = [book_image_term(title)] if cover else []
+        if author and not os.path.isdir(os.path.join(self.library_dir, author)):
+            search_terms.append(author_image_term(author))
+
+        with self.lock:
+            for search_term in search_terms:
+                if search_term in self.images:
+                    self.images[search_term][1] += 1
+                else:
+                    logging.info('Prefetching image for search term: %s', search_term)
+                    self.images[search_term] = [self.executor.submit(find_image, search_term), 1]
+        return search_terms
+
+    # Returns Image for search term, waiting for it if it was
+    # prefetched and looking for it now if it wasn't
+    # Books that prefetched it still have to discard() it
+    def get(self, search_term):
+        with self.lock:
+            image = self.images.get(search_term)
+        if image:
+            try:
+                return image[0].result()
+            except concurrent.futures.CancelledError:
+                pass
+        return find_image(search_term)
+
+    # Let go of image for search term, dropping it if nobody else wants it
+    def discard(self, search_term):
+        with self.lock:
+            image = self.images.get(search_term)
+            if not image:
+                return
+            image[1] -= 1
+            if image[1] > 0:
+                return
+            del self.images[search_term]
+
+        if image[0].cancel():
+            logging.info('Discarding prefetched image for search term: %s', search_term)
+
+    # Cancel everything that hasn't started yet
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+
+
+# Padding callback for mutagen's save(), decides how much space is left after
+# the tags
+# Changing the amount of padding means moving all the audio after the tags, so
+# the padding a file has is kept whenever the new tags fit in it, even if it is
+# more than mutagen would choose. When tags don't fit, plenty of padding is left
+# so they fit next time.
+class Tag_Padding:
+
+    def __init__(self, padding):
+        # Least amount of padding to leave when making room for tags
+        self.padding = padding
+        # Number of saves, and how many of those had to move audio data
+        self.saves = 0
+        self.rewrites = 0
+        # Bytes of audio data moved to make room
+        self.bytes_moved = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, info):
+        with self.lock:
+            self.saves += 1
+            if info.padding >= 0:
+                return info.padding
+
+            self.rewrites += 1
+            self.bytes_moved += info.size
+        padding = max(self.padding, info.get_default_padding())
+        logging.info('Tags do not fit in padding, moving %d bytes to leave %d bytes of padding',
+                     info.size, padding)
+        return padding
+
+    # Add counts from saves made elsewhere, like in a worker process
+    def add(self, saves, rewrites, bytes_moved):
+        with self.lock:
+            self.saves += saves
+            self.rewrites += rewrites
+            self.bytes_moved += bytes_moved
+
+
+# Shared by everything that cleans up names
+normalizer = Normalizer(config.WORDS, config.SPEC_CHARS)
+
+# Shared by everything that writes tags
+tag_padding = Tag_Padding(config.TAG_PADDING)
+
+
+#########################################################
+#                     AUDIO PROBE                       #
+#########################################################
+
+# Reading stats with mutagen parses much more of the file than we need, so
+# common formats are handled by reading only their headers. Files are never
+# written to.
+
+# Stats read from the headers of an audio file
+class Audio_Probe:
+    # Type of audio container, as named by mutagen
+    container = ""
+    bitrate = 0 # In bits/second
+    length = 0.0 # In seconds
+    # (offset, length, MIME type) of embedded cover art, if any
+    cover = None
+    # Title, album, artist, albumartist, isbn and asin already in the file
+    tags = {}
+
+    def __init__(self, container="", bitrate=0, length=0.0, cover=None, tags=None):
+        self.container = container
+        self.bitrate = int(bitrate)
+        self.length = length
+        self.cover = cover
+        self.tags = tags or {}
+
+
+# Returns Audio_Probe with stats of audio file
+# Falls back to mutagen for formats the probe can't handle
+def probe_audio(path):
+    probe = probe_native(path)
+    if probe is None:
+        logging.debug('Falling back to mutagen for: %s', path)
+        probe = probe_mutagen(path)
+    return probe
+
+
+# Get stats of formats that can be read without mutagen
+# Returns Audio_Probe, or None if file could not be read this way
+def probe_native(path):
+    with open(path, 'rb') as f:
+        return probe_file(f, path)
+
+
+# Get stats of audio file at 'path' that is already open as 'f'
+# Returns Audio_Probe, or None if file could not be read this way
+def probe_file(f, path):
+    ext = os.path.splitext(path)[-1].lower()
+    probe = None
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if ext == '.mp3':
+            probe = probe_mp3(f, size)
+            if probe:
+                probe.cover = id3_picture(f)
+                probe.tags = id3_tags(f)
+        elif ext in ['.mp4', '.m4a', '.m4b']:
+            probe = probe_mp4(f, size)
+        elif ext in ['.ogg', '.oga', '.opus']:
+            probe = probe_ogg(f, size)
+        elif ext == '.flac':
+            probe = probe_flac(f, size)
+    except (struct.error, ValueError, IndexError, KeyError, ZeroDivisionError) as e:
+        logging.debug('Could not probe %s. Reason: %s', path, e)
+        probe = None
+    return probe
+
+
+# Get stats of any format mutagen knows about
+def probe_mutagen(path):
+    try:
+        audio = mutagen.File(path)
+    except mutagen.MutagenError as e:
+        logging.error('Could not read audio file %s. Reason: %s', path, e)
+        return Audio_Probe()
+    return mutagen_stats(audio)
+
+
+# Containers named after the 'easy' interface they were opened with, by the
+# name the probe gives them
+MUTAGEN_CONTAINERS = {'easymp3': 'mp3', 'easymp4': 'mp4'}
+
+
+# Get stats of audio file already opened by mutagen
+def mutagen_stats(audio):
+    probe = Audio_Probe()
+    if audio is None:
+        return probe
+    container = type(audio).__name__.lower()
+    probe.container = MUTAGEN_CONTAINERS.get(container, container)
+    probe.bitrate = int(getattr(audio.info, 'bitrate', 0) or 0)
+    probe.length = getattr(audio.info, 'length', 0.0) or 0.0
+    return probe
+
+
+# Read up to 'size' bytes at 'offset'
+def read_at(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+
+# Returns size of ID3v2 tag at 'offset', or 0 if there is none
+def id3_size(f, offset=0):
+    header = read_at(f, offset, 10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return 0
+    # Size is stored as a 'syncsafe' integer, 7 bits per byte
+    size = (header[6] << 21) | (header[7] << 14) | (header[8] << 7) | header[9]
+    # Footer present
+    if header[5] & 0x10:
+        size += 10
+    return size + 10
+
+
+# Kilobits per second by (MPEG version 1 or 2, layer) and bitrate index
+MP3_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# Sample rates by MPEG version and sample rate index
+MP3_SAMPLE_RATES = {
+    1: [44100, 48000, 32000],
+    2: [22050, 24000, 16000],
+    2.5: [11025, 12000, 8000],
+}
+
+
+# Parse MPEG audio frame header at data[i]
+# Returns dict of frame info, or None if there is no valid header there
+def mp3_frame(data, i):
+    if i + 4 > len(data) or data[i] != 0xFF or data[i+1] & 0xE0 != 0xE0:
+        return None
+    version_bits = (data[i+1] >> 3) & 3
+    layer_bits = (data[i+1] >> 1) & 3
+    bitrate_index = data[i+2] >> 4
+    rate_index = (data[i+2] >> 2) & 3
+    padding = (data[i+2] >> 1) & 1
+    # Reserved values, and 'free format' which we can't measure
+    if version_bits == 1 or layer_bits == 0 or bitrate_index in [0, 15] or rate_index == 3:
+        return None
+
+    version = {0: 2.5, 2: 2, 3: 1}[version_bits]
+    layer = 4 - layer_bits
+    bitrate = MP3_BITRATES[(1 if version == 1 else 2, layer)][bitrate_index] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_index]
+    if layer == 1:
+        samples = 384
+        frame_length = (12 * bitrate // sample_rate + padding) * 4
+    else:
+        samples = 1152 if layer == 2 or version == 1 else 576
+        frame_length = samples // 8 * bitrate // sample_rate + padding
+
+    return {'version': version,
+            'bitrate': bitrate,
+            'sample_rate': sample_rate,
+            'samples': samples,
+            'mono': data[i+3] >> 6 == 3,
+            'length': frame_length}
+
+
+def probe_mp3(f, size):
+    # Skip ID3v2 tag, and ID3v1 tag at end of file
+    start = id3_size(f)
+    end = size
+    if size >= 128 and read_at(f, size - 128, 3) == b'TAG':
+        end -= 128
+
+    # Find first frame, making sure the one after it lines up too so we don't
+    # get fooled by junk that looks like a frame header
+    data = read_at(f, start, 65536)
+    i = data.find(b'\xff')
+    frame = None
+    while i != -1:
+        frame = mp3_frame(data, i)
+        if frame:
+            following = i + frame['length']
+            if following + 4 > len(data) or mp3_frame(data, following):
+                break
+        frame = None
+        i = data.find(b'\xff', i + 1)
+    if frame is None:
+        return None
+
+    # Look for a Xing/Info header giving the number of frames
+    if frame['version'] == 1:
+        xing = i + 4 + (17 if frame['mono'] else 32)
+    else:
+        xing = i + 4 + (9 if frame['mono'] else 17)
+    if data[xing:xing+4] in [b'Xing', b'Info']:
+        flags = struct.unpack('>I', data[xing+4:xing+8])[0]
+        frames = audio_bytes = None
+        position = xing + 8
+        if flags & 0x1:
+            frames = struct.unpack('>I', data[position:position+4])[0]
+            position += 4
+        if flags & 0x2:
+            audio_bytes = struct.unpack('>I', data[position:position+4])[0]
+        if frames:
+            length = frames * frame['samples'] / frame['sample_rate']
+            bitrate = (audio_bytes or end - start - i) * 8 / length
+            return Audio_Probe('mp3', bitrate, length)
+
+    # Or a VBRI header, always 32 bytes after the frame header
+    vbri = i + 4 + 32
+    if data[vbri:vbri+4] == b'VBRI':
+        audio_bytes, frames = struct.unpack('>II', data[vbri+10:vbri+18])
+        length = frames * frame['samples'] / frame['sample_rate']
+        return Audio_Probe('mp3', audio_bytes * 8 / length, length)
+
+    # Otherwise assume constant bitrate
+    length = (end - start - i) * 8 / frame['bitrate']
+    return Audio_Probe('mp3', frame['bitrate'], length)
+
+
+# MIME types of MP4 picture data types
+MP4_PICTURE_TYPES = {13: 'image/jpeg', 14: 'image/png'}
+
+# Tags read from MP4 'ilst' atoms
+MP4_TAGS = {b'\xa9nam': 'title', b'\xa9alb': 'album', b'\xa9ART': 'artist', b'aART': 'albumartist'}
+
+
+# Find MP4 atoms between 'start' and 'end', reading only their headers
+# Yields (name, payload offset, end offset) of each
+def mp4_atoms(f, start, end):
+    offset = start
+    while offset + 8 <= end:
+        size, name = struct.unpack('>I4s', read_at(f, offset, 8))
+        header = 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            header = 16
+        elif size == 0:
+            size = end - offset
+        if size < header:
+            raise ValueError('Invalid MP4 atom size')
+        yield name, offset + header, offset + size
+        offset += size
+
+
+def probe_mp4(f, size):
+    # Length comes from 'moov/mvhd', bitrate from the size of the media data
+    moov = None
+    media_bytes = 0
+    for name, start, end in mp4_atoms(f, 0, size):
+        if name == b'moov':
+            moov = (start, end)
+        elif name == b'mdat':
+            media_bytes += end - start
+    if moov is None:
+        return None
+
+    for name, start, end in mp4_atoms(f, moov[0], moov[1]):
+        if name == b'mvhd':
+            data = read_at(f, start, 32)
+            if data[0] == 1:
+                timescale, duration = struct.unpack('>IQ', data[20:32])
+            else:
+                timescale, duration = struct.unpack('>II', data[12:20])
+            length = duration / timescale
+            bitrate = media_bytes * 8 / length if length else 0
+            ilst = mp4_find(f, moov[0], moov[1], [b'udta', b'meta', b'ilst'])
+            if ilst is None:
+                return Audio_Probe('mp4', bitrate, length)
+            return Audio_Probe('mp4', bitrate, length, mp4_picture(f, *ilst), mp4_tags(f, *ilst))
+    return None
+
+
+# Find atom at 'path' below atom with children between 'start' and 'end'
+# Returns (start, end) of its contents, or None
+def mp4_find(f, start, end, path):
+    for path_name in path:
+        for name, child_start, child_end in mp4_atoms(f, start, end):
+            if name == path_name:
+                start, end = child_start, child_end
+                break
+        else:
+            return None
+        # 'meta' has version and flags before its children
+        if path_name == b'meta' and read_at(f, start + 4, 4) != b'hdlr':
+            start += 4
+    return start, end
+
+
+# Find cover art in 'covr' atom of MP4 'ilst' atom
+# Returns (offset, length, MIME type) of picture data, or None
+def mp4_picture(f, start, end):
+    covr = mp4_find(f, start, end, [b'covr'])
+    if covr is None:
+        return None
+
+    # Each picture is in a 'data' atom, after its type and locale
+    for name, data_start, data_end in mp4_atoms(f, *covr):
+        if name == b'data':
+            data_type = struct.unpack('>I', read_at(f, data_start, 4))[0]
+            mime = MP4_PICTURE_TYPES.get(data_type)
+            if mime:
+                return (data_start + 8, data_end - data_start - 8, mime)
+    return None
+
+
+# Read title, album, artist, ISBN and ASIN from MP4 'ilst' atom
+# ISBN and ASIN are freeform '----' atoms, named by their 'name' atom
+# Returns dict of tags found
+def mp4_tags(f, start, end):
+    tags = {}
+    for name, item_start, item_end in mp4_atoms(f, start, end):
+        if name == b'----':
+            tag = None
+            for child, child_start, child_end in mp4_atoms(f, item_start, item_end):
+                # 'name' has version and flags before the name
+                if child == b'name':
+                    tag = TAG_NAMES.get(read_at(f, child_start + 4, min(child_end - child_start - 4, 64)).decode('utf-8', 'replace').upper())
+        else:
+            tag = MP4_TAGS.get(name)
+        if tag is None or tag in tags:
+            continue
+
+        # Text is in a 'data' atom, after its type and locale
+        for child, child_start, child_end in mp4_atoms(f, item_start, item_end):
+            if child == b'data':
+                value = read_at(f, child_start + 8, min(child_end - child_start - 8, 4096))
+                value = value.decode('utf-8', 'replace').strip()
+                if value:
+                    tags[tag] = value
+                break
+    return tags
+
+
+def probe_ogg(f, size):
+    # First page holds the codec header
+    data = read_at(f, 0, 4096)
+    if data[:4] != b'OggS':
+        return None
+    serial = data[14:18]
+    packet = data[27 + data[26]:]
+    if packet[:7] == b'\x01vorbis':
+        container = 'oggvorbis'
+        sample_rate, nominal_bitrate = struct.unpack('<I4xi', packet[12:24])
+        pre_skip = 0
+    elif packet[:8] == b'OpusHead':
+        # Opus always runs at 48kHz, whatever the input rate was
+        container = 'oggopus'
+        sample_rate = 48000
+        nominal_bitrate = 0
+        pre_skip = struct.unpack('<H', packet[10:12])[0]
+    else:
+        return None
+
+    # Length is the granule position of the last page of the stream
+    tail_start = max(0, size - 65536)
+    tail = read_at(f, tail_start, 65536)
+    i = tail.rfind(b'OggS')
+    granule = -1
+    while i != -1:
+        if len(tail) >= i + 18 and tail[i+14:i+18] == serial:
+            granule = struct.unpack('<q', tail[i+6:i+14])[0]
+            if granule >= 0:
+                break
+        i = tail.rfind(b'OggS', 0, i)
+    if granule < 0:
+        return None
+
+    length = max(0, granule - pre_skip) / sample_rate
+    if nominal_bitrate > 0:
+        bitrate = nominal_bitrate
+    else:
+        bitrate = size * 8 / length if length else 0
+
+    # Comment header is the packet after the codec header, starting on the
+    # next page
+    tags = {}
+    packet = ogg_packet(f, 27 + data[26] + sum(data[27:27 + data[26]]), serial)
+    if packet[:7] == b'\x03vorbis':
+        tags = vorbis_tags(packet[7:])
+    elif packet[:8] == b'OpusTags':
+        tags = vorbis_tags(packet[8:])
+    return Audio_Probe(container, bitrate, length, tags=tags)
+
+
+# Read Ogg packet that starts on page at 'offset', up to VORBIS_COMMENT_LIMIT
+# bytes of it
+def ogg_packet(f, offset, serial):
+    packet = b''
+    while len(packet) < VORBIS_COMMENT_LIMIT:
+        header = read_at(f, offset, 27)
+        if len(header) < 27 or header[:4] != b'OggS':
+            break
+        lacing = read_at(f, offset + 27, header[26])
+        offset += 27 + header[26]
+        if header[14:18] != serial:
+            offset += sum(lacing)
+            continue
+        packet += read_at(f, offset, sum(lacing))
+        offset += sum(lacing)
+        # Packet ends with the first segment shorter than 255 bytes
+        if any(segment < 255 for segment in lacing):
+            break
+    return packet
+
+
+# Largest part of a Vorbis comment block that is read, since they can hold
+# whole pictures
+VORBIS_COMMENT_LIMIT = 256 * 1024
+
+
+# Read title, album, artist, ISBN and ASIN from Vorbis comments, as used by
+# FLAC, Ogg Vorbis and Opus files
+# Comments that go past the end of 'data' are ignored
+# Returns dict of tags found
+def vorbis_tags(data):
+    tags = {}
+    position = 4 + struct.unpack('<I', data[:4])[0]
+    if position + 4 > len(data):
+        return tags
+    count = struct.unpack('<I', data[position:position+4])[0]
+    position += 4
+    for i in range(count):
+        if position + 4 > len(data):
+            break
+        length = struct.unpack('<I', data[position:position+4])[0]
+        comment = data[position+4:position+4+length]
+        position += 4 + length
+        name, separator, value = comment.partition(b'=')
+        tag = TAG_NAMES.get(name.decode('ascii', 'replace').upper())
+        value = value.decode('utf-8', 'replace').strip()
+        if tag and separator and value and position <= len(data):
+            tags.setdefault(tag, value)
+    return tags
+
+
+# Tags read from Vorbis comments, ID3 'TXXX' frames and MP4 freeform atoms,
+# by their name in the file
+TAG_NAMES = {'TITLE': 'title', 'ALBUM': 'album', 'ARTIST': 'artist',
+             'ALBUMARTIST': 'albumartist', 'ALBUM ARTIST': 'albumartist',
+             'ISBN': 'isbn', 'ASIN': 'asin', 'AUDIBLE_ASIN': 'asin'}
+
+
+def probe_flac(f, size):
+    # FLAC files are sometimes given ID3 tags anyway
+    offset = id3_size(f)
+    if read_at(f, offset, 4) != b'fLaC':
+        return None
+    offset += 4
+
+    # Walk metadata blocks to find STREAMINFO, pictures, and where the audio
+    # starts
+    stream_info = None
+    pictures = []
+    tags = {}
+    last = False
+    while not last:
+        header = read_at(f, offset, 4)
+        if len(header) < 4:
+            return None
+        last = header[0] & 0x80
+        block_type = header[0] & 0x7F
+        block_length = int.from_bytes(header[1:4], 'big')
+        if block_type == 0:
+            stream_info = read_at(f, offset + 4, 34)
+        elif block_type == 4:
+            tags = vorbis_tags(read_at(f, offset + 4, min(block_length, VORBIS_COMMENT_LIMIT)))
+        elif block_type == 6:
+            # Picture type and MIME type, then description, then size and
+            # color depth, then the picture data
+            picture_type, mime_length = struct.unpack('>II', read_at(f, offset + 4, 8))
+            mime = read_at(f, offset + 12, mime_length).decode('ascii', 'replace')
+            description_length = struct.unpack('>I', read_at(f, offset + 12 + mime_length, 4))[0]
+            position = offset + 16 + mime_length + description_length + 16
+            data_length = struct.unpack('>I', read_at(f, position, 4))[0]
+            pictures.append((picture_type, position + 4, data_length, mime))
+        offset += 4 + block_length
+    if stream_info is None or len(stream_info) < 18:
+        return None
+
+    # 20 bits of sample rate, then channels and bits per sample, then 36 bits of
+    # total samples
+    sample_rate = (stream_info[10] << 12) | (stream_info[11] << 4) | (stream_info[12] >> 4)
+    total_samples = ((stream_info[13] & 0x0F) << 32) | int.from_bytes(stream_info[14:18], 'big')
+    length = total_samples / sample_rate
+    bitrate = (size - offset) * 8 / length if length else 0
+    return Audio_Probe('flac', bitrate, length, choose_picture(pictures), tags)
+
+
+# Walk frames of ID3v2 tag at start of file
+# ID3v2.2 frame names are given as their ID3v2.3 names
+# Yields (frame name, offset of frame data, size, usable) where frames that
+# are compressed, encrypted or unsynchronised are not usable, since they can't
+# be read straight out of the file
+# Bytes some frame flags add before the data, like a group ID, are skipped
+def id3_frames(f):
+    header = read_at(f, 0, 10)
+    if len(header) < 10 or header[:3] != b'ID3':
+        return
+    version = header[3]
+    end = id3_size(f)
+    # Whole tag is unsynchronised
+    if header[5] & 0x80 and version < 4:
+        return
+
+    # Skip extended header
+    offset = 10
+    if header[5] & 0x40:
+        data = read_at(f, offset, 4)
+        if version == 4:
+            offset += (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+        else:
+            offset += 4 + struct.unpack('>I', data)[0]
+
+    # ID3v2.2 has shorter frame headers and names
+    header_length = 6 if version == 2 else 10
+    while offset + header_length <= end:
+        frame = read_at(f, offset, header_length)
+        # Padding
+        if len(frame) < header_length or frame[0] == 0:
+            break
+        extra = 0
+        if version == 2:
+            frame_id = ID3V22_FRAMES.get(frame[:3], frame[:3])
+            size = int.from_bytes(frame[3:6], 'big')
+            usable = True
+        elif version == 4:
+            frame_id = frame[:4]
+            size = (frame[4] << 21) | (frame[5] << 14) | (frame[6] << 7) | frame[7]
+            # Compressed, encrypted or unsynchronised
+            usable = not frame[9] & 0x0E
+            # Group ID, and data length indicator
+            extra = (1 if frame[9] & 0x40 else 0) + (4 if frame[9] & 0x01 else 0)
+        else:
+            frame_id = frame[:4]
+            size = struct.unpack('>I', frame[4:8])[0]
+            # Compressed or encrypted
+            usable = not frame[9] & 0xC0
+            # Group ID
+            extra = 1 if frame[9] & 0x20 else 0
+
+        if extra > size:
+            usable = False
+            extra = 0
+        yield frame_id, offset + header_length + extra, size - extra, usable
+        offset += header_length + size
+
+
+# ID3v2.3 names of the ID3v2.2 frames that are read
+ID3V22_FRAMES = {b'PIC': b'APIC', b'TT2': b'TIT2', b'TAL': b'TALB',
+                 b'TP1': b'TPE1', b'TP2': b'TPE2', b'TXX': b'TXXX'}
+
+# Tags read from ID3 text frames
+ID3_TAGS = {b'TIT2': 'title', b'TALB': 'album', b'TPE1': 'artist', b'TPE2': 'albumartist'}
+
+
+# Find cover art in ID3v2 tag at start of file
+# Returns (offset, length, MIME type) of picture data, or None
+def id3_picture(f):
+    version = read_at(f, 3, 1)
+    pictures = []
+    for frame_id, offset, size, usable in id3_frames(f):
+        if frame_id == b'APIC' and usable:
+            picture = id3_picture_frame(read_at(f, offset, min(size, 4096)), version[0])
+            if picture:
+                picture_type, data_start, mime = picture
+                pictures.append((picture_type, offset + data_start, size - data_start, mime))
+    return choose_picture(pictures)
+
+
+# Read title, album, artist, ISBN and ASIN from ID3v2 tag at start of file
+# Returns dict of tags found
+def id3_tags(f):
+    tags = {}
+    for frame_id, offset, size, usable in id3_frames(f):
+        if not usable or size < 2 or (frame_id not in ID3_TAGS and frame_id != b'TXXX'):
+            continue
+        data = read_at(f, offset, min(size, 4096))
+        values = id3_text(data[1:], data[0])
+        if frame_id == b'TXXX':
+            # User defined text, named by its description
+            if len(values) > 1 and values[0].upper() in TAG_NAMES:
+                tags.setdefault(TAG_NAMES[values[0].upper()], values[1])
+        elif values:
+            tags.setdefault(ID3_TAGS[frame_id], values[0])
+    return tags
+
+
+# Decode text of ID3 frame, which may hold several null separated strings
+def id3_text(data, encoding):
+    if encoding == 1:
+        text = data.decode('utf-16', 'replace')
+    elif encoding == 2:
+        text = data.decode('utf-16-be', 'replace')
+    elif encoding == 3:
+        text = data.decode('utf-8', 'replace')
+    else:
+        text = data.decode('latin-1')
+    # UTF-16 strings after the first have their own byte order mark
+    return [value.lstrip('\ufeff').strip() for value in text.split('\x00') if value.strip('\ufeff ')]
+
+
+# Parse start of APIC or PIC frame
+# Returns (picture type, offset of picture data in frame, MIME type), or None
+def id3_picture_frame(data, version):
+    encoding = data[0]
+    if version == 2:
+        mime = {b'JPG': 'image/jpeg', b'PNG': 'image/png'}.get(data[1:4].upper(), '')
+        position = 4
+    else:
+        mime_end = data.index(b'\x00', 1)
+        mime = data[1:mime_end].decode('latin-1').lower()
+        position = mime_end + 1
+    picture_type = data[position]
+    position += 1
+
+    # Description ends with a null character, two bytes long in UTF-16
+    if encoding in [1, 2]:
+        while data[position:position+2] != b'\x00\x00':
+            if position >= len(data):
+                return None
+            position += 2
+        position += 2
+    else:
+        position = data.index(b'\x00', position) + 1
+
+    # Older files sometimes leave out the 'image/'
+    if mime in ['jpg', 'jpeg', 'png']:
+        mime = 'image/' + mime.replace('jpg', 'jpeg')
+    return picture_type, position, mime
+
+
+# Pick front cover out of list of (picture type, offset, length, MIME type),
+# otherwise the first picture
+# Only JPEG and PNG pictures are used
+# Returns (offset, length, MIME type), or None
+def choose_picture(pictures):
+    pictures = [picture for picture in pictures
+                if picture[3] in ['image/jpeg', 'image/png'] and picture[2] > 0]
+    if not pictures:
+        return None
+    # Picture type 3 is the front cover
+    for picture in pictures:
+        if picture[0] == 3:
+            return picture[1:]
+    return pictures[0][1:]
+
+
+#########################################################
+#                    FILE TRANSFER                      #
+#########################################################
+
+# Audio files are copied by the kernel rather than read into Python and written
+# back out. Files are cloned when the filesystem can share their data, which
+# takes no time at all.
+
+# ioctl request for cloning a file on Linux (Btrfs, XFS, ...)
+FICLONE = 0x40049409
+
+# Most bytes to ask the kernel to copy in one call
+TRANSFER_CHUNK = 64 * 1024 * 1024
+
+# Errors meaning a copy method isn't supported for these files
+UNSUPPORTED_ERRORS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+
+# Copy file along with its metadata, like shutil.copy2
+# Returns number of bytes copied
+def copy_file(source, destination):
+    with open(source, 'rb') as fsrc, open(destination, 'wb') as fdst:
+        size = os.fstat(fsrc.fileno()).st_size
+        if not clone_file(fsrc, fdst):
+            kernel_copy(fsrc, fdst, size)
+    shutil.copystat(source, destination)
+    return size
+
+
+# Move file, copying it if it is on another filesystem
+# Returns number of bytes moved
+def move_file(source, destination):
+    size = os.stat(source).st_size
+    try:
+        os.rename(source, destination)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        copy_file(source, destination)
+        os.remove(source)
+    return size
+
+
+# Make destination share the data of source, returns False if not supported
+def clone_file(fsrc, fdst):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+        return True
+    except OSError:
+        return False
+
+
+# Copy size bytes from 'start' in one open file to the start of another
+# copy_file_range lets NFS servers copy without sending data over the network,
+# then sendfile, then a plain copy for anything the kernel won't do
+def kernel_copy(fsrc, fdst, size, start=0):
+    infd = fsrc.fileno()
+    outfd = fdst.fileno()
+    offset = 0
+
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while offset < size:
+                sent = os.copy_file_range(infd, outfd, min(TRANSFER_CHUNK, size - offset), start + offset, offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRORS:
+                raise
+
+    if offset < size and hasattr(os, 'sendfile'):
+        # sendfile writes at the current position of the destination
+        os.lseek(outfd, offset, os.SEEK_SET)
+        try:
+            while offset < size:
+                sent = os.sendfile(outfd, infd, start + offset, min(TRANSFER_CHUNK, size - offset))
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRORS:
+                raise
+
+    if offset < size:
+        fsrc.seek(start + offset)
+        fdst.seek(offset)
+        while offset < size:
+            data = fsrc.read(min(1024 * 1024, size - offset))
+            if not data:
+                break
+            fdst.write(data)
+            offset += len(data)
+
+
+# Clone file along with its metadata, copying it instead if the filesystem
+# can't share file data
+# Returns number of bytes cloned
+def reflink_file(source, destination):
+    with open(source, 'rb') as fsrc, open(destination, 'wb') as fdst:
+        cloned = clone_file(fsrc, fdst)
+    if not cloned:
+        logging.warning('Could not clone file, copying instead: %s', os.path.basename(source))
+        return copy_file(source, destination)
+    shutil.copystat(source, destination)
+    return os.stat(destination).st_size
+
+
+# Hard link file, copying it instead if that isn't possible
+# Returns number of bytes linked
+def link_file(source, destination):
+    try:
+        os.link(source, destination)
+    except OSError as e:
+        logging.warning('Could not hard link file, copying instead: %s. Reason: %s', os.path.basename(source), e)
+        return copy_file(source, destination)
+    return os.stat(destination).st_size
+
+
+# Give file its own copy of its data if it is a symlink or hard link, so
+# writing to it doesn't change the original
+def unshare_file(path):
+    if not os.path.islink(path) and os.stat(path).st_nlink < 2:
+        return
+    logging.info('Copying linked file before writing to it: %s', os.path.basename(path))
+    temp_path = path + '.granger'
+    try:
+        copy_file(path, temp_path)
+        os.replace(temp_path, path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+# Bring file into the library the way 'import_mode' says to
+# Returns number of bytes transferred
+def transfer_file(source, destination, import_mode):
+    # Link when the library is on the same filesystem, since that takes no
+    # time or space
+    if import_mode == "auto":
+        if os.stat(source).st_dev == os.stat(os.path.dirname(destination)).st_dev:
+            import_mode = "hardlink"
+        else:
+            import_mode = "copy"
+
+    logging.info('Importing file (%s): %s', import_mode, os.path.basename(source))
+    logging.info('Destination: %s', destination)
+    if import_mode == "move":
+        return move_file(source, destination)
+    elif import_mode == "hardlink":
+        return link_file(source, destination)
+    elif import_mode == "reflink":
+        return reflink_file(source, destination)
+    elif import_mode == "symlink":
+        os.symlink(os.path.abspath(source), destination)
+        return os.stat(source).st_size
+    else:
+        return copy_file(source, destination)
+
+
 #########################################################
 #                   HELPER FUNCTIONS                    #
 #########################################################
 
-def reset_download_dir():
-    download_dir = "/tmp/granger/"
-    
-    logging.info('Clearing download directory: %s', download_dir)
+# Find audio files in 'inputs', a list of files and directories
+# Files are yielded a few directories at a time as lists of (path, os.stat()
+# result), in the same order every time for the same number of workers. Files
+# given on their own come first, all together, without stats.
+# Directories are read by 'workers' threads at once, since on network
+# filesystems most of the time is spent waiting on the server
+def find_files(inputs, recursive, workers):
+    workers = max(1, workers)
+    files = [(path, None) for path in inputs if os.path.isfile(path)]
+    if files:
+        yield files
+
+    # Lists of directories still to be read, next one last
+    waiting = directory_batches([path for path in inputs if os.path.isdir(path)])
+    waiting.reverse()
+    # Lists of directories being read, oldest first
+    reading = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while waiting or reading:
+            # Keep a few more reads going than there are workers, so workers
+            # never wait on the generator
+            while waiting and len(reading) < workers * 2:
+                reading.append(executor.submit(read_directories, waiting.pop(), recursive))
+
+            files, subdirectories = reading.popleft().result()
+            if files:
+                yield files
+            # Read subdirectories before moving on to the next batch
+            waiting.extend(reversed(directory_batches(subdirectories)))
+
+
+# Read directories, keeping only audio files
+# Stats of audio files are taken here, while other directories are being read,
+# so they don't have to be taken again later
+# Returns list of (path, os.stat() result) of audio files, and list of
+# subdirectories if 'recursive' is set
+def read_directories(directories, recursive):
+    files = []
+    subdirectories = []
+    for directory in directories:
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    # Make sure extension is valid before statting file
+                    if entry.is_file():
+                        if os.path.splitext(entry.name)[-1] in FORMATS:
+                            try:
+                                files.append((entry.path, entry.stat()))
+                            except OSError as e:
+                                logging.warning('Could not stat file: %s. Reason: %s', entry.path, e)
+                    elif recursive and entry.is_dir(follow_symlinks=False):
+                        subdirectories.append(entry.path)
+        except OSError as e:
+            logging.warning('Could not read directory: %s. Reason: %s', directory, e)
+    return files, subdirectories
+
+
+# Split directories into lists that have to be read together
+# Files are grouped by their whole path, so files in directories that only
+# differ by part numbers (like 'CD1' and 'CD2') can end up in the same book
+def directory_batches(directories):
+    batches = {}
+    for directory in directories:
+        batches.setdefault(normalizer.group_key(directory), []).append(directory)
+    return list(batches.values())
+
+
+# Search term for cover image of book with 'title'
+def book_image_term(title):
+    return "\"" + title + "\" audiobook"
+
+
+# Search term for image of author with 'name'
+def author_image_term(name):
+    return "\"" + name + "\" author"
+
+
+# Get image for search term, using one that was prefetched if there is one
+def fetch_image(search_term):
+    if image_prefetcher:
+        return image_prefetcher.get(search_term)
+    return find_image(search_term)
+
+
+# Get image for search term from image store, searching for it if it isn't
+# there
+# Searches that find nothing are remembered too, but ones that fail are not
+def find_image(search_term):
+    if image_store and not args.refresh:
+        known, image = image_store.get(search_term)
+        if known:
+            logging.info('Using stored image for search term: %s', search_term)
+            return image
+
+    # Image search uses libraries that may fail in their own ways, an image
+    # isn't worth stopping for
+    try:
+        image = get_image(search_term)
+    except Exception as e:
+        logging.warning('Image search failed for search term: %s. Reason: %s', search_term, e)
+        return None
 
-    # Ensure directory exists
-    if not os.path.isdir(download_dir):
-        os.mkdir(download_dir)
-        
-    # Empty directory
-    for filename in os.listdir(download_dir):
-        file_path = os.path.join(download_dir, filename)
+    # Image is still used if it can't be stored
+    if image_store:
         try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)
-        except Exception as e:
-            logging.error('Failed to delete %s. Reason: %s', file_path, e)
-        
+            image_store.put(search_term, image)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning('Could not store image for search term: %s. Reason: %s', search_term, e)
+    return image
 
-# Takes a search term and returns path to resulting image
+
+# Takes a search term and returns resulting Image, or None if nothing was found
+# Raises Lookup_Error if search or download fails
 # google_images_download is not currently working
 # Works with fork by Joeclinton1
 # https://github.com/Joeclinton1/google-images-download/tree/patch-1
@@ -1465,33 +3832,242 @@ def get_image(search_term):
     # Cleanse search term
     search_term = search_term.replace(',', '')
     
-    # Get single square image and store in /tmp
-    response = google_images_download.googleimagesdownload()
-
-    # Set download parameters
+    # Only get URL of single square image, we download it ourselves
+    # Set search parameters
     arguments = {'keywords':search_term,
                  'limit':1,
                  'aspect_ratio':'square',
-                 'output_directory':'/tmp/granger/',
+                 'no_download':True,
                  'silent_mode':True}
+
+    # Search and download have to be done in time together
+    deadline = time.monotonic() + config.IMAGE_TIMEOUT
     
-    # Download images while redirecting output
-    paths = response.download(arguments)
+    # Image searches count towards the request rate, but not the Books quota
+    if rate_limiter:
+        rate_limiter.acquire(cancel=write_cancel)
+
+    # Search for images while redirecting output
+    # google_images_download doesn't let us set timeouts, so bound the whole
+    # call instead
+    result = call_with_timeout(search_images, config.IMAGE_TIMEOUT, write_cancel, arguments)
+
+    # Result is ({search term: [URLs]}, number of errors). Most failures only
+    # show up as an empty list, so it only counts as finding nothing when the
+    # search went through without errors.
+    try:
+        paths, errors = result
+        urls = paths[search_term]
+    except (TypeError, ValueError, KeyError):
+        raise Lookup_Error('Image search did not complete')
+    if not urls:
+        if errors:
+            raise Lookup_Error('Image search failed with ' + str(errors) + ' errors')
+        logging.warning('No images found for search term: %s', search_term)
+        return None
+    url = urls[0]
 
     try:
-        return paths[0][search_term][0]
-    except:
-        logging.warning('No images downloaded for search term: %s', search_term)
+        return download_image(url, deadline)
+    except requests.exceptions.RequestException as e:
+        raise Lookup_Error(e)
+
+
+# Download image at 'url' into memory and return it as Image
+# Raises Lookup_Error if it isn't an image or 'deadline' passes
+def download_image(url, deadline=None):
+    # Share connections with Google Books lookups
+    session = books_client.session if books_client else requests
+    response = session.get(url, timeout=request_timeout(deadline))
+    response.raise_for_status()
+
+    # Name file after type of image, or after URL if type is unknown
+    content_type = response.headers.get('Content-Type', '').split(';')[0].strip().lower()
+    if content_type and not content_type.startswith('image/'):
+        raise Lookup_Error('Not an image: ' + content_type)
+    extension = mimetypes.guess_extension(content_type) if content_type else None
+    if not extension:
+        extension = os.path.splitext(urllib.parse.urlparse(url).path)[-1].lower() or '.jpg'
+
+    return Image(response.content, extension)
+
+
+# Returns (connect, read) timeout for a request, cut short so it ends before
+# 'deadline' (from time.monotonic()) if given
+def request_timeout(deadline=None):
+    connect_timeout = config.CONNECT_TIMEOUT
+    read_timeout = config.READ_TIMEOUT
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise Lookup_Error('Deadline exceeded')
+        connect_timeout = min(connect_timeout, remaining)
+        read_timeout = min(read_timeout, remaining)
+    return (connect_timeout, read_timeout)
+
+
+# Search for images with google_images_download
+# Runs in a process of its own, see call_with_timeout()
+def search_images(arguments):
+    return google_images_download.googleimagesdownload().download(arguments)
+
+
+# Runs module level function in a separate process and returns its result
+# Raises Lookup_Error if it fails, takes longer than 'timeout' seconds or
+# 'cancel' event is set. The process and anything it started (like a browser)
+# are killed once we are done with it, so nothing is left running. Used for
+# libraries that don't let us set timeouts ourselves.
+def call_with_timeout(function, timeout, cancel, *arguments):
+    context = multiprocessing.get_context('spawn')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=call_in_process, args=(sender, function) + arguments, daemon=True)
+    process.start()
+    sender.close()
+
+    try:
+        end = time.monotonic() + timeout
+        while not receiver.poll(0.5):
+            if cancel and cancel.is_set():
+                raise Lookup_Error('Cancelled')
+            if time.monotonic() >= end:
+                raise Lookup_Error('Timed out after ' + str(timeout) + ' seconds')
+            if not process.is_alive() and not receiver.poll():
+                raise Lookup_Error('Process exited with code ' + str(process.exitcode))
+        try:
+            error, value = receiver.recv()
+        except EOFError:
+            raise Lookup_Error('Process exited without a result')
+    finally:
+        receiver.close()
+        kill_process(process)
+
+    if error:
+        raise Lookup_Error(error)
+    return value
+
+
+# Runs in process started by call_with_timeout() and sends back (error, value)
+def call_in_process(sender, function, *arguments):
+    # Get a process group of our own, so everything we start is killed with us
+    if hasattr(os, 'setpgrp'):
+        os.setpgrp()
+    # Leave Ctrl-C to the main process
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        result = (None, function(*arguments))
+    except Exception as e:
+        # Exceptions from other libraries may not survive being sent back
+        result = (type(e).__name__ + ': ' + str(e), None)
+    sender.send(result)
+    sender.close()
+
+
+# Kill process started by call_with_timeout() and its process group
+def kill_process(process):
+    if hasattr(os, 'killpg'):
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+    if process.is_alive():
+        process.kill()
+    process.join()
+
+
+# Takes value of a 'Retry-After' header and returns number of seconds to wait
+# The header may be given as a number of seconds or as an HTTP date
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
         return None
+    # Dates with a '-0000' zone come back without one, but are still UTC
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+# Scores Google Books items against search term and returns list of matches,
+# best first
+# Every text is turned into a set of integer word IDs once, then the title,
+# title + author and title + subtitle + author of each item are scored against
+# the search term's
+def rank_matches(search_term, items):
+    query = normalizer.tokens(search_term)
+    variants = []
+    for item in items:
+        info = item['volumeInfo']
+
+        # Fix formatting and capitalization of title, subtitle, and author
+        if 'title' in info:
+            info['title'] = normalizer.format_title(info['title'])
+        if 'subtitle' in info:
+            info['subtitle'] = titleify(info['subtitle'])
+        if 'authors' in info:
+            info['authors'][0] = normalizer.format_author(info['authors'][0])
+
+        title = normalizer.tokens(info.get('title', ''))
+        subtitle = normalizer.tokens(info.get('subtitle', ''))
+        author = frozenset()
+        if 'authors' in info:
+            author = normalizer.tokens(info['authors'][0])
+
+        variants.append(title)
+        variants.append(title | author)
+        variants.append(title | subtitle | author)
+
+    # Best of the three comparisons for each item, then sort so equally good
+    # items keep the order Google gave them
+    ratios = jaccard_scores(query, variants)
+    best = [max(ratios[i:i+3]) for i in range(0, len(ratios), 3)]
+    order = sorted(range(len(best)), key=lambda i: best[i], reverse=True)
+
+    return [{"ratio": best[i], "info": items[i]['volumeInfo']} for i in order]
+
+
+# Album and artist tags that don't say anything about the book
+UNKNOWN_TAGS = ["", "unknown", "unknown album", "unknown artist", "various artists", "audiobook"]
+
+
+# Returns ISBN-10 or ISBN-13 in 'text' without separators, or None if it isn't
+# a valid one
+def parse_isbn(text):
+    isbn = re.sub('[^0-9X]', '', text.upper())
+    if len(isbn) == 10 and re.match('^[0-9]{9}[0-9X]$', isbn):
+        total = sum((10 - i) * (10 if c == 'X' else int(c)) for i, c in enumerate(isbn))
+        if total % 11 == 0:
+            return isbn
+    elif len(isbn) == 13 and isbn.isdigit():
+        total = sum((3 if i % 2 else 1) * int(c) for i, c in enumerate(isbn))
+        if total % 10 == 0:
+            return isbn
+    return None
+
+
+# Returns ISBN-13 of any ISBN
+def isbn_13(isbn):
+    if len(isbn) == 13:
+        return isbn
+    isbn = '978' + isbn[:9]
+    check = -sum((3 if i % 2 else 1) * int(c) for i, c in enumerate(isbn)) % 10
+    return isbn + str(check)
+
+
+# Jaccard similarity of query with each of rows, all sets of word IDs
+def jaccard_scores(query, rows):
+    ratios = []
+    for row in rows:
+        union = len(query | row)
+        ratios.append(len(query & row) / union if union else 0.0)
+    return ratios
 
 
-# Used to find similarity between filename and results from Google Books API
-def jaccard_similarity(list1, list2):
-    s1 = set(list1)
-    s2 = set(list2)
-    return len(s1.intersection(s2)) / len(s1.union(s2))
-    
-    
 # Colors used for terminal output
 class colors:
     HEADER =    '\033[95m'
@@ -1523,16 +4099,28 @@ def format_length(length):
 def terminate(signal, frame):
     logging.info('Received SIGTERM signal, exiting.')
     print(colors.RESET + "Received SIGTERM signal, exiting...")
+    # Quota is saved on the way out of main(), not here, since this thread may
+    # already hold the rate limiter's lock
+    write_cancel.set()
     stop_fetch_thread()
     stop_select_thread()
     stop_write_thread()
     
+# Patterns used by titleify
+TITLEIFY_ROMAN_REGEX = re.compile(r'(?:[^a-z0-9]|\s)?[IVXLDCM]{2,}(?:[^a-z0-9]|\s|$)', re.MULTILINE)
+TITLEIFY_SEPARATOR_REGEX = re.compile(r'(?::| - )[^a-z]*[a-z]', re.MULTILINE)
+TITLEIFY_BRACKETS_TABLE = str.maketrans('', '', '[]{}()<>')
+TITLEIFY_LOWER_WORDS = {'a', 'an', 'the', 'for', 'and', 'nor', 'but', 'or', 'yet', 'so',
+                        'as', 'at', 'by', 'in', 'of', 'on', 'out', 'per', 'to', 'up', 'via'}
+
 # Fix capitalizations of title and subtitle
 # Do NOT capitalize articles, coordinate conjunctions, nor prepositions
 # that are shorter than three letters long
+# Results are remembered, since the same names come back in many searches
+@functools.lru_cache(maxsize=4096)
 def titleify(title):
     # Find and match Roman numerals
-    matches = re.findall(r'(?:[^a-z0-9]|\s)?[IVXLDCM]{2,}(?:[^a-z0-9]|\s|$)', title, re.MULTILINE)
+    matches = TITLEIFY_ROMAN_REGEX.findall(title)
     
     title = title.lower()
     
@@ -1540,14 +4128,12 @@ def titleify(title):
     for match in matches:
         title = title.replace(match.lower(), match)
         
-    for char in ['[', ']', '{', '}', '(', ')', '<', '>']:
-        title = title.replace(char, '')
+    title = title.translate(TITLEIFY_BRACKETS_TABLE)
 
     words = title.split(' ')   
     title = string.capwords(words.pop(0))
     for word in words:
-        if word in ['a', 'an', 'the', 'for', 'and', 'nor', 'but', 'or', 'yet', 'so',
-                    'as', 'at', 'by', 'in', 'of', 'on', 'out', 'per', 'to', 'up', 'via']:
+        if word in TITLEIFY_LOWER_WORDS:
             title += ' ' + word
         else:
             if word.isupper():
@@ -1556,11 +4142,12 @@ def titleify(title):
                 title += ' ' + string.capwords(word)
     
     # Find ': ' or ' - ' in string and capitalize next letter
-    for match in re.findall(r'(?::| - )[^a-z]*[a-z]', title, re.MULTILINE):
+    for match in TITLEIFY_SEPARATOR_REGEX.findall(title):
         title = title.replace(match.lower(), string.capwords(match))
     
     return title
 
 
+
 if __name__ == "__main__":
     main()